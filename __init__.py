@@ -1,4 +1,6 @@
 from . import tasks
 from . import gpflow_tasks
+from . import storage
+from . import offline
 from .helpers import *
 from .tasks import OptimisationTimeout
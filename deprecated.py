@@ -1,113 +1,80 @@
-import sys
-import time
+"""
+The pre-v2.0 interface, implemented on top of `helpers.OptimisationHelper` and the tasks in `tasks`.
+"""
 import numpy as np
 import pandas as pd
 
+from . import helpers
+from . import tasks
 
-class OptimisationIterationEvent(object):
-    def __init__(self, func, sequence, trigger="iter"):
-        self._func = func
-        self._seq = sequence
-        self._trigger = trigger
-        self._next = next(self._seq) if self._seq is not None else np.inf
 
-    def __call__(self, logger, x, fg=None, final=False):
-        if (self._trigger == "iter" and logger._i >= self._next) or (
-                        self._trigger == "time" and time.time() - logger._start_time >= self._next) or final:
-            self._func(x)
-            self._next = next(self._seq)
+class _LegacyLogOptimisation(tasks.LogOptimisation):
+    """
+    Log in the old format: `t` is the total running time, and an existing record for the current iteration is kept.
+    """
 
+    def _get_columns(self, logger):
+        return ['i', 't', 'f', 'gnorm', 'g', 'x']
 
-class OptimisationLogger(object):
-    def __init__(self, f, disp_sequence=None, hist_sequence=None, g=None, chaincallback=None, store_fullg=False,
-                 store_x=False, hist=None):
-        # Options
-        self._f = f
-        self._g = g
+    def _setup_logger(self, logger):
+        hist = self._old_hist if self._old_hist is not None else pd.DataFrame(columns=self._get_columns(logger))
+        self._set_hist(logger, hist)
+        if len(hist) > 0:
+            logger._i = hist.iloc[-1, :].i
+            logger._opt_timer.add_time(hist.iloc[-1, :].t)
+            logger._total_timer.add_time(hist.iloc[-1, :].t)
 
-        disp_event = OptimisationIterationEvent(self._disp_func,
-                                                disp_sequence if disp_sequence is not None else seq_exp_lin(1.5, 1000),
-                                                "iter")
+    def _get_record(self, logger, x, f=None):
+        f, g = logger._fg(x)
+        return dict(zip(self._get_hist(logger).columns,
+                        (logger._i, logger._total_timer.elapsed_time, f, np.linalg.norm(g),
+                         g if self._store_fullg else 0.0, x.copy() if self._store_x is not None else None)))
 
-        log_event = OptimisationIterationEvent(self._log_hist_func,
-                                               hist_sequence if hist_sequence is not None else seq_exp_lin(1.5, 1000),
-                                               "iter")
+    def _event_handler(self, logger, x, final, f=None):
+        hist = self._get_hist(logger)
+        if len(hist) > 0 and hist.iloc[-1, :].i == logger._i:
+            return
+        self._set_hist(logger, hist.append(self._get_record(logger, x), ignore_index=True))
 
-        self._events = [disp_event, log_event]
 
-        self._chaincallback = chaincallback
-        self._store_fullg = store_fullg
-        self._store_x = store_x
+class _LegacyGPflowLogOptimisation(_LegacyLogOptimisation, tasks.GPflowLogOptimisation):
+    def _get_columns(self, logger):
+        return ['i', 't', 'f', 'gnorm', 'g'] + list(logger.model.get_parameter_dict().keys())
 
-        # Working variables
-        self._last_disp = (0, time.time())
-        self._i = 0
-        self._start_time = time.time()
+    def _get_record(self, logger, x, f=None):
+        f, g = logger._fg(x)
+        log_dict = dict(zip(self._get_hist(logger).columns[:5],
+                            (logger._i, logger._total_timer.elapsed_time, f, np.linalg.norm(g),
+                             g if self._store_fullg else 0.0)))
+        log_dict.update(self._get_param_record(logger, x))
+        return log_dict
 
-        # Public members
 
-        if hist is None:
-            self.hist = pd.DataFrame(columns=['i', 't', 'f', 'gnorm', 'g', 'x'])
-        else:
-            self._continue_from_hist(hist)
+class _LegacyTimeout(tasks.Timeout):
+    def _event_handler(self, logger, x, final):
+        if not self._triggered and not final:
+            self._triggered = True
+            logger.finish(x)
+            raise KeyboardInterrupt
 
-        print("Iter\tfunc\t\tgrad\t\titer/s\t\tTimestamp")
 
-    def _fg(self, x):
-        """
-        Distinguish between separate functions for f and g or a single one, and call the appropriate ones.
-        :param x:
-        :return:
-        """
-        f = self._f(x)
-        if type(f) is tuple or type(f) is list:
-            return f
-        elif self._g is not None:
-            return f, self._g(x)
-        else:
-            return f, 0.0
-
-    def _disp_func(self, x):
-        # Print and log
-        f, g = self._fg(x)
-        iter_per_time = (self._i - self._last_disp[0]) / (time.time() - self._last_disp[1])
-        sys.stdout.write("\r")
-        sys.stdout.write(
-            "%i\t%e\t%e\t%f\t%s\t" % (self._i, f, np.linalg.norm(g), iter_per_time, time.ctime()))
-        sys.stdout.flush()
-        self._last_disp = (self._i, time.time())
-
-    def _log_hist_func(self, x, f=None):
-        if len(self.hist) > 0 and self.hist.iloc[-1, :].i == self._i:
-            return
-        if f is None:
-            f, g = self._fg(x)
-        self.hist = self.hist.append(dict(zip(self.hist.columns,
-                                              (self._i, time.time() - self._start_time, f, np.linalg.norm(g),
-                                               g if self._store_fullg else 0.0,
-                                               x.copy() if self._store_x else None))),
-                                     ignore_index=True)
-
-    def callback(self, x, final=False):
-        self._i += 1
-        for event in self._events:
-            event(self, x, final=final)
-
-        if self._chaincallback is not None:
-            self._chaincallback(x)
-
-    def _continue_from_hist(self, hist):
-        """
-        Reset the timer to continue from where hist left off.
-        """
-        self.hist = hist
-        if len(self.hist) > 0:
-            self._start_time = time.time() - self.hist.iloc[-1, :].t
-            self._i = self.hist.iloc[-1, :].i
+class OptimisationLogger(helpers.OptimisationHelper):
+    def __init__(self, f, disp_sequence=None, hist_sequence=None, g=None, chaincallback=None, store_fullg=False,
+                 store_x=False, hist=None):
+        self._store_fullg = store_fullg
+        self._store_x = store_x
+        super(OptimisationLogger, self).__init__(f, self._get_tasks(disp_sequence, hist_sequence, hist), g,
+                                                 chaincallback)
+
+    def _get_tasks(self, disp_sequence, hist_sequence, hist):
+        return [
+            tasks.DisplayOptimisation(disp_sequence if disp_sequence is not None else seq_exp_lin(1.5, 1000)),
+            self._get_log_task(hist_sequence if hist_sequence is not None else seq_exp_lin(1.5, 1000), hist)
+        ]
 
-    def finish(self, x):
-        for event in self._events:
-            event._func(x)
+    def _get_log_task(self, sequence, hist):
+        return _LegacyLogOptimisation(sequence, old_hist=hist, store_fullg=self._store_fullg,
+                                      store_x=True if self._store_x else None)
 
 
 class OptimisationHelper(OptimisationLogger):
@@ -126,63 +93,43 @@ class OptimisationHelper(OptimisationLogger):
         :param timeout:
         :param store_path: File where history is stored.
         """
-        super(OptimisationHelper, self).__init__(f, disp_sequence, hist_sequence, g, chaincallback, store_fullg,
-                                                 store_x, hist)
+        if store_sequence is not None and store_path is None:
+            raise ValueError("Need a `store_path` to store history file.")
         self._verbose = verbose
+        self._store_path = store_path
+        self._store_sequence = store_sequence
+        self._store_trigger = store_trigger
         if (hist is not None) and (len(hist) > 0):
             timeout = timeout + hist.iloc[-1, :].t
+        self._timeout = timeout
+        super(OptimisationHelper, self).__init__(f, disp_sequence, hist_sequence, g, chaincallback, store_fullg,
+                                                 store_x, hist)
 
-        self._timeout_event = OptimisationIterationEvent(self._timeout_func, seq_exp_lin(1.0, timeout, timeout), "time")
-        store_event = OptimisationIterationEvent(self._store_func, store_sequence, store_trigger)
-        self._events.append(store_event)
-
-        self._store_path = store_path
-        if store_sequence is not None and store_path is None:
-            raise ValueError("Need a `store_path` to store history file.")
-
-    def _timeout_func(self, x):
-        self.finish(x)
-        raise KeyboardInterrupt
-
-    def _store_func(self, x):
-        st = time.time()
-        self.hist.to_pickle(self._store_path)
-        if self._verbose:
-            print("")
-            print("Stored history in %.2fs" % (time.time() - st))
+    def _get_tasks(self, disp_sequence, hist_sequence, hist):
+        task_list = super(OptimisationHelper, self)._get_tasks(disp_sequence, hist_sequence, hist)
+        if self._store_path is not None:
+            task_list.append(tasks.StoreOptimisationHistory(self._store_path, self._store_sequence,
+                                                            self._store_trigger, self._verbose))
+        if np.isfinite(self._timeout):
+            task_list.append(_LegacyTimeout(self._timeout))
+        return task_list
 
     def store_hist(self):
         self.hist.to_pickle(self._store_path)
 
-    def callback(self, x, final=False):
-        super(OptimisationHelper, self).callback(x, final)
-        self._timeout_event(self, x)
 
-
-class GPflowOptimisationHelper(OptimisationHelper):
+class GPflowOptimisationHelper(helpers._GPflowModelMixin, OptimisationHelper):
     def __init__(self, model, disp_sequence=None, hist_sequence=None, store_sequence=None,
                  chaincallback=None, store_fullg=False, store_x=False, timeout=np.inf, store_path=None,
                  store_trigger="time", hist=None, verbose=False):
-        if hist is None:
-            hist = pd.DataFrame(columns=['i', 't', 'f', 'gnorm', 'g'] + list(model.get_parameter_dict().keys()))
+        self._setup_model(model, None)
         super(GPflowOptimisationHelper, self).__init__(None, disp_sequence, hist_sequence, store_sequence, None,
                                                        chaincallback, store_fullg, store_x, timeout, store_path,
                                                        store_trigger, hist, verbose)
-        self.model = model
-
-    def _fg(self, x):
-        return self.model._objective(x)
-
-    def _log_hist_func(self, x, f=None):
-        if len(self.hist) > 0 and self.hist.iloc[-1, :].i == self._i:
-            return
-        if f is None:
-            f, g = self._fg(x)
-        log_dict = dict(zip(self.hist.columns[:5], (
-            self._i, time.time() - self._start_time, f, np.linalg.norm(g), g if self._store_fullg else 0.0)))
-        log_dict.update(self.model.get_samples_df(x[None, :].copy()).iloc[0, :].to_dict())
 
-        self.hist = self.hist.append(log_dict, ignore_index=True)
+    def _get_log_task(self, sequence, hist):
+        return _LegacyGPflowLogOptimisation(sequence, old_hist=hist, store_fullg=self._store_fullg,
+                                            store_x=True if self._store_x else None)
 
     @property
     def param_hist(self):
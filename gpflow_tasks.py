@@ -10,9 +10,9 @@ import opt_tools
 
 class GPflowBenchmarkTrackerBase(opt_tools.tasks.GPflowLogOptimisation):
     def __init__(self, test_X, test_Y, sequence, trigger="iter", old_hist=None, store_fullg=False, store_x=True,
-                 store_x_columns=None, verbose=False):
+                 store_x_columns=None, verbose=False, wal_path=None):
         opt_tools.tasks.GPflowLogOptimisation.__init__(self, sequence, trigger, old_hist, store_fullg, store_x,
-                                                       store_x_columns)
+                                                       store_x_columns, wal_path)
         self.test_X = test_X
         self.test_Y = test_Y
         self.verbose = verbose
@@ -1,7 +1,15 @@
+import concurrent.futures
 import contextlib
+import cProfile
+import io
+import math
+import pickle
+import pstats
+import threading
 import time
 
 import numpy as np
+import pandas as pd
 
 
 class Stopwatch(object):
@@ -40,10 +48,181 @@ class Stopwatch(object):
         self.start()
 
 
+class FiniteDifferenceGradient(object):
+    def __init__(self, f, eps=1e-6, method="central", num_workers=None, executor="thread"):
+        """
+        Finite difference gradient of `f`, with the function evaluations for the different coordinates run in parallel.
+        Pass it as `g` to `OptimisationHelper`, and pass the helper's `_fg` to the optimiser with `jac=True`, so the
+        optimiser and the tasks use the same gradient. The last gradient is memoised.
+        :param f: Objective function, returning a scalar.
+        :param eps: Step size, relative to max(1, |x_i|).
+        :param method: Finite difference scheme (central | forward). Forward differences reuse the objective at `x`.
+        :param num_workers: Number of workers in the pool.
+        :param executor: Type of pool (thread | process). For processes, `f` needs to be picklable.
+        """
+        if method not in ["central", "forward"]:
+            raise ValueError("Unknown value for method: %s." % str(method))
+        if executor not in ["thread", "process"]:
+            raise ValueError("Unknown value for executor: %s." % str(executor))
+        self._f = f
+        self._eps = eps
+        self._method = method
+        self._num_workers = num_workers
+        self._executor = executor
+        self._pool = None
+        self._prev_x = None
+        self._prev_g = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self._executor == "process":
+                self._pool = concurrent.futures.ProcessPoolExecutor(self._num_workers)
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self._num_workers)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __call__(self, x, f0=None):
+        """
+        :param x: Point to evaluate the gradient at.
+        :param f0: Objective at `x`, if already known.
+        :return: Gradient vector.
+        """
+        if self._prev_x is not None and np.all(self._prev_x == x):
+            return self._prev_g
+
+        x = np.asarray(x, dtype=float)
+        h = self._eps * np.maximum(1.0, np.abs(x))
+        steps = np.diag(h)
+        if self._method == "central":
+            points = list(x + steps) + list(x - steps)
+        else:
+            points = list(x + steps) + ([x] if f0 is None else [])
+        fvals = np.array(list(self._get_pool().map(self._f, points)), dtype=float)
+        if self._method == "central":
+            g = (fvals[:len(x)] - fvals[len(x):]) / (2.0 * h)
+        else:
+            g = (fvals[:len(x)] - (fvals[-1] if f0 is None else f0)) / h
+
+        self._prev_x = x.copy()
+        self._prev_g = g
+        return g
+
+
+class EvaluationTrace(object):
+    _dtype = np.dtype([('timestamp', 'f8'), ('duration', 'f8'), ('f', 'f8'), ('step', 'f8'), ('iteration', 'i8'),
+                       ('internal', '?')])
+
+    def __init__(self, capacity=100000, profile_every=None, profile_threshold=0.0, max_profiles=20):
+        """
+        Records every objective evaluation in a ring buffer: its timestamp, duration, objective value, distance from the
+        previously evaluated point, the helper's iteration, and whether it was requested by a task (`internal`) rather
+        than the optimiser. Pass it as `trace` to a helper. For `OptimisationHelper`, pass the helper's `_fg` to the
+        optimiser, or wrap the objective with `wrap`, so the optimiser's evaluations are traced as well.
+        :param capacity: Number of evaluations to keep.
+        :param profile_every: Run every n-th evaluation under cProfile.
+        :param profile_threshold: Only keep profiles of evaluations that take at least this long (s).
+        :param max_profiles: Maximum number of profiles to keep.
+        """
+        self._buffer = np.zeros(capacity, dtype=self._dtype)
+        self._profile_every = profile_every
+        self._profile_threshold = profile_threshold
+        self._max_profiles = max_profiles
+        self._lock = threading.Lock()
+        self._prev_x = None
+        self._helper = None
+        self.num_evaluations = 0
+        self.profiles = []  # List of (timestamp, duration, profile report)
+
+    def bind(self, helper):
+        self._helper = helper
+
+    def call(self, fun, x):
+        """
+        Evaluate `fun(x)` and record the evaluation.
+        """
+        profile = (self._profile_every is not None and self.num_evaluations % self._profile_every == 0 and
+                   len(self.profiles) < self._max_profiles)
+        timestamp = time.time()
+        if profile:
+            profiler = cProfile.Profile()
+            val = profiler.runcall(fun, x)
+        else:
+            val = fun(x)
+        duration = time.time() - timestamp
+
+        with self._lock:
+            record = self._buffer[self.num_evaluations % len(self._buffer)]
+            record['timestamp'] = timestamp
+            record['duration'] = duration
+            record['f'] = val[0] if type(val) is tuple or type(val) is list else val
+            record['step'] = (np.linalg.norm(x - self._prev_x)
+                              if self._prev_x is not None and np.shape(self._prev_x) == np.shape(x) else np.nan)
+            record['iteration'] = self._helper._i if self._helper is not None else -1
+            record['internal'] = self._helper is not None and self._helper._running_tasks
+            self._prev_x = np.array(x, copy=True)
+            self.num_evaluations += 1
+            if profile and duration >= self._profile_threshold:
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(30)
+                self.profiles.append((timestamp, duration, report.getvalue()))
+        return val
+
+    def wrap(self, fun):
+        def traced(x):
+            return self.call(fun, x)
+        return traced
+
+    def to_frame(self):
+        """
+        :return: The recorded evaluations in chronological order, as a pandas DataFrame.
+        """
+        with self._lock:
+            n = len(self._buffer)
+            if self.num_evaluations <= n:
+                records = self._buffer[:self.num_evaluations].copy()
+            else:
+                records = np.roll(self._buffer, -(self.num_evaluations % n))
+        return pd.DataFrame(records)
+
+    def store(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'evaluations': self.to_frame(), 'profiles': list(self.profiles)}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+_task_pool = None
+
+
+def _get_task_pool():
+    global _task_pool
+    if _task_pool is None:
+        _task_pool = concurrent.futures.ThreadPoolExecutor()
+    return _task_pool
+
+
 class OptimisationHelper(object):
-    def __init__(self, f, tasks, g=None, chaincallback=None):
+    def __init__(self, f, tasks, g=None, chaincallback=None, cache=None, trace=None):
+        """
+        :param f: Objective function, returning the objective or a list/tuple of objective and gradient.
+        :param tasks: List of tasks.
+        :param g: Gradient function, or a `FiniteDifferenceGradient`.
+        :param chaincallback: Callback to call after the tasks.
+        :param cache: `storage.EvaluationCache` for evaluations of `_fg`.
+        :param trace: `EvaluationTrace` to record the evaluations in.
+        """
         self._f = f
         self._g = g
+        self._cache = cache
+        self._trace = trace
+        if trace is not None:
+            trace.bind(self)
+        self._running_tasks = True  # Whether evaluations are requested by tasks, see `EvaluationTrace`
+        self._fg_lock = threading.RLock()  # Tasks can run concurrently
         self.tasks = tasks
         self._chaincallback = chaincallback
         self._i = 0
@@ -56,8 +235,25 @@ class OptimisationHelper(object):
 
         for task in self.tasks:
             task.setup(self)
+        self._running_tasks = False
 
     def _fg(self, x):
+        with self._fg_lock:
+            if self._cache is not None:
+                val = self._cache.get(x)
+                if val is not None:
+                    return val
+            val = self._evaluate_traced(x)
+            if self._cache is not None:
+                self._cache.put(x, tuple(val))
+            return val
+
+    def _evaluate_traced(self, x):
+        if self._trace is None:
+            return self._evaluate(x)
+        return self._trace.call(self._evaluate, x)
+
+    def _evaluate(self, x):
         """
         Distinguish between separate functions for f and g or a single one, and call the appropriate ones.
         :param x:
@@ -66,23 +262,96 @@ class OptimisationHelper(object):
         f = self._f(x)
         if type(f) is tuple or type(f) is list:
             return f
+        elif isinstance(self._g, FiniteDifferenceGradient):
+            return f, self._g(x, f0=f)
         elif self._g is not None:
             return f, self._g(x)
         else:
             return f, 0.0
 
+    def _run_tasks(self, x, final, skip=None):
+        """
+        Run the tasks in order. Consecutive thread-safe tasks (see `OptimisationIterationEvent.concurrent`) are run
+        concurrently on a shared thread pool, respecting their dependencies. All of them finish before the next task
+        that is not thread-safe, and before returning. Dependencies have to come earlier in the task list.
+        :param skip: Predicate on a task, called just before the task would be started. Tasks for which it returns True
+                     are not run, and count as finished for the tasks depending on them.
+        """
+        positions = dict((id(task), n) for n, task in enumerate(self.tasks))
+        for n, task in enumerate(self.tasks):
+            for dep in getattr(task, 'depends_on', []):
+                if positions.get(id(dep), n) >= n:
+                    raise ValueError("%s depends on %s, which is not listed before it in the tasks." %
+                                     (type(task).__name__, type(dep).__name__))
+
+        running_tasks, self._running_tasks = self._running_tasks, True
+        try:
+            done = set()
+            group = []
+            for task in self.tasks:
+                if getattr(task, 'thread_safe', False):
+                    if skip is not None and skip(task):
+                        done.add(id(task))
+                    else:
+                        group.append(task)
+                else:
+                    self._run_concurrent(group, x, final, done)
+                    group = []
+                    if skip is None or not skip(task):
+                        task(self, x, final=final)
+                    done.add(id(task))
+            self._run_concurrent(group, x, final, done)
+        finally:
+            self._running_tasks = running_tasks
+
+    def _run_concurrent(self, group, x, final, done):
+        """
+        Run a group of thread-safe tasks, starting each once the tasks in its `depends_on` are in `done`.
+        """
+        if len(group) <= 1:
+            for task in group:
+                task(self, x, final=final)
+                done.add(id(task))
+            return
+
+        pending = list(group)
+        running = {}
+        error = None
+        while len(running) > 0 or (len(pending) > 0 and error is None):
+            if error is None:
+                for task in list(pending):
+                    if all(id(dep) in done for dep in task.depends_on):
+                        running[_get_task_pool().submit(task, self, x, final)] = task
+                        pending.remove(task)
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                else:
+                    done.add(id(task))
+        if error is not None:
+            raise error
+
     def callback(self, x, final=False):
         with self._opt_timer.pause():
             self._i += 1
-            for task in self.tasks:
-                task(self, x, final=final)
+            self._run_tasks(x, final)
 
             if self._chaincallback is not None:
                 self._chaincallback(x)
 
-    def finish(self, x):
-        for task in self.tasks:
-            task(self, x, final=True)
+    def finish(self, x, skip=None):
+        """
+        Run all tasks with `final=True`, and shut down the pool of a `FiniteDifferenceGradient`.
+        :param skip: Predicate on a task, see `_run_tasks`.
+        """
+        try:
+            self._run_tasks(x, True, skip)
+        finally:
+            if isinstance(self._g, FiniteDifferenceGradient):
+                self._g.close()
 
 
 class NanError(RuntimeError):
@@ -91,45 +360,198 @@ class NanError(RuntimeError):
         self.indices = np.where(np.logical_not(np.isfinite(val)))[0]
 
 
-class GPflowOptimisationHelper(OptimisationHelper):
-    def __init__(self, model, tasks, chaincallback=None):
+def _model_identity(model):
+    """
+    Everything the objective of a GPflow model depends on apart from its free state: the classes of the model and its
+    components, the values of the DataHolders and fixed parameters, the transforms and priors, and the length of the
+    free state.
+    """
+    items = []
+
+    def walk(parameterized):
+        items.append(type(parameterized).__module__ + '.' + type(parameterized).__name__)
+        for d in sorted(getattr(parameterized, 'data_holders', []), key=lambda d: d.long_name):
+            items.append((d.long_name, np.asarray(d.value)))
+        for p in parameterized.sorted_params:
+            if hasattr(p, 'sorted_params'):
+                walk(p)
+            else:
+                items.append((p.long_name, str(p.transform), str(p.prior),
+                              np.asarray(p.value) if p.fixed else None))
+
+    walk(model)
+    return items, len(model.get_free_state())
+
+
+class _GPflowModelMixin(object):
+    """
+    Evaluation of the objective of a GPflow model for an `OptimisationHelper`, shared with the deprecated interface.
+    """
+
+    def _setup_model(self, model, cache):
         self.model = model
         if self.model._needs_recompile:
             self.model._compile()
+        if cache is not None:
+            cache.scope(_model_identity(self.model))
 
         # Variables for `_fg` memoisation.
         self._prev_x = None
         self._prev_val = None
+        self._objective_wrapped = False  # Whether `model._objective` is cached and traced, see `optimize`
 
-        super(GPflowOptimisationHelper, self).__init__(None, tasks, None, chaincallback)
-        self._opt_timer.stop()
-        self._total_timer.stop()
+    def _wrap_objective(self, objective):
+        """
+        Record the evaluations of `objective` in the trace, and look them up in / add them to the cache.
+        """
+        if self._trace is not None:
+            objective = self._trace.wrap(objective)
+        if self._cache is not None:
+            objective = self._cache.wrap(objective)
+        return objective
 
     def _fg(self, x):
         if np.any(np.logical_not(np.isfinite(x))):
             raise NanError(x)
 
-        if self._prev_x is None or np.any(self._prev_x != x):
-            self._prev_x = x.copy()
-            old_fevals = self.model.num_fevals
-            self._prev_val = self.model._objective(x)
-            self.model.num_fevals = old_fevals
-        return self._prev_val
+        with self._fg_lock:
+            if self._prev_x is None or np.any(self._prev_x != x):
+                old_fevals = self.model.num_fevals
+                if self._objective_wrapped:
+                    val = self.model._objective(x)
+                else:
+                    val = self._wrap_objective(self.model._objective)(x)
+                self.model.num_fevals = old_fevals
+                self._prev_x = x.copy()
+                self._prev_val = val
+            return self._prev_val
+
+
+class GPflowOptimisationHelper(_GPflowModelMixin, OptimisationHelper):
+    def __init__(self, model, tasks, chaincallback=None, cache=None, trace=None):
+        """
+        :param model: GPflow model.
+        :param tasks: List of tasks.
+        :param chaincallback: Callback to call after the tasks.
+        :param cache: `storage.EvaluationCache`. A digest of the model (see `_model_identity`) is added to its
+                      identity, so the cache only needs to be created with e.g. the name of the experiment.
+        :param trace: `EvaluationTrace` to record the evaluations in.
+        """
+        self._setup_model(model, cache)
+        super(GPflowOptimisationHelper, self).__init__(None, tasks, None, chaincallback, cache, trace)
+        self._opt_timer.stop()
+        self._total_timer.stop()
 
     def optimize(self, method='L-BFGS-B', tol=None, callback=None, maxiter=1000, opt_options=None, **kwargs):
         self._chaincallback = callback
         self._opt_options = opt_options
+        if self.model._needs_recompile:
+            self.model._compile()
+        if self._cache is not None:
+            self._cache.scope(_model_identity(self.model))  # Parameters may have been fixed since
+        objective = self.model._objective
+        self.model._objective = self._wrap_objective(objective)
+        self._objective_wrapped = True
         self._opt_timer.start()
         self._total_timer.start()
-        r = self.model.optimize(method, tol, self.callback, maxiter, **kwargs)
-        self._opt_timer.stop()
-        self._total_timer.stop()
+        try:
+            r = self.model.optimize(method, tol, self.callback, maxiter, **kwargs)
+        finally:
+            self._opt_timer.stop()
+            self._total_timer.stop()
+            self.model._objective = objective
+            self._objective_wrapped = False
         if r is None:
             raise KeyboardInterrupt
         else:
             return r
 
 
+class StochasticOptimisationHelper(OptimisationHelper):
+    def __init__(self, f, tasks, g=None, full_f=None, batch_size=1, smoothing=0.9, chaincallback=None, trace=None):
+        """
+        Helper for minibatch optimisation. `f` (and `g`) evaluate the objective on a fresh minibatch, and are only
+        called by the optimisation loop in `optimize`. Tasks calling `_fg` receive the exponentially smoothed
+        minibatch objective and the last minibatch gradient, without any extra evaluations.
+        :param f: Minibatch objective, returning the objective or a list/tuple of objective and gradient.
+        :param tasks: List of tasks.
+        :param g: Minibatch gradient, if not returned by `f`.
+        :param full_f: Full-data objective, used by `full_objective`. Can be expensive.
+        :param batch_size: Number of datapoints per minibatch, used for the samples/s rate.
+        :param smoothing: Decay of the exponential moving average of the minibatch objective.
+        :param trace: `EvaluationTrace` to record the minibatch evaluations in.
+        """
+        self._full_f = full_f
+        self.batch_size = batch_size
+        self.smoothing = smoothing
+        self.num_samples = 0
+        self.minibatch_f = np.nan
+        self._num_minibatches = 0
+        self._f_ema = 0.0
+        self._last_g = 0.0
+        self._prev_full = (None, np.nan)
+        super(StochasticOptimisationHelper, self).__init__(f, tasks, g, chaincallback, trace=trace)
+        self._opt_timer.stop()
+        self._total_timer.stop()
+
+    @property
+    def smoothed_f(self):
+        if self._num_minibatches == 0:
+            return np.nan
+        return self._f_ema / (1.0 - self.smoothing ** self._num_minibatches)
+
+    def minibatch_objective(self, x):
+        """
+        Evaluate the objective on a minibatch and update the running statistics.
+        """
+        f, g = self._evaluate_traced(x)
+        self.num_samples += self.batch_size
+        self._num_minibatches += 1
+        self._f_ema = self.smoothing * self._f_ema + (1.0 - self.smoothing) * f
+        self.minibatch_f = f
+        self._last_g = g
+        return f, g
+
+    def full_objective(self, x):
+        """
+        Evaluate the full-data objective. Returns NaN if no `full_f` was given.
+        """
+        if self._full_f is None:
+            return np.nan
+        if self._prev_full[0] is None or np.any(self._prev_full[0] != x):
+            f = self._full_f(x)
+            self._prev_full = (x.copy(), f[0] if type(f) is tuple or type(f) is list else f)
+        return self._prev_full[1]
+
+    def _fg(self, x):
+        if self._num_minibatches == 0:
+            self.minibatch_objective(x)
+        return self.smoothed_f, self._last_g
+
+    def optimize(self, x0, update, maxiter=1000, callback=None):
+        """
+        Run the stochastic optimisation loop.
+        :param x0: Initial parameter vector.
+        :param update: Function `update(x, g)` returning the next parameter vector, e.g. an SGD or Adam step.
+        :param maxiter: Number of iterations.
+        :param callback: Chained callback, called with the new parameter vector after the tasks.
+        :return: Final parameter vector.
+        """
+        self._chaincallback = callback
+        x = np.array(x0, dtype=float)
+        self._opt_timer.start()
+        self._total_timer.start()
+        try:
+            for _ in range(maxiter):
+                _, g = self.minibatch_objective(x)
+                x = update(x, g)
+                self.callback(x)
+        finally:
+            self._opt_timer.stop()
+            self._total_timer.stop()
+        return x
+
+
 def seq_exp_lin(growth, max, start=1.0, start_jump=None):
     start_jump = start if start_jump is None else start_jump
     gap = start_jump
@@ -138,3 +560,50 @@ def seq_exp_lin(growth, max, start=1.0, start_jump=None):
         yield gap + last
         last = last + gap
         gap = min(gap * growth, max)
+
+
+class OverheadBudget(object):
+    def __init__(self, target=0.05, min_gap=1.0, max_gap=np.inf, start=1.0, smoothing=0.5):
+        """
+        Adaptive schedule for tasks, which spaces the firings of a task so that its overhead stays below a fraction of
+        the total running time. The cost of a task is a moving average over its recent firings, so it follows tasks
+        that get slower as the run goes on. For "iter" triggers, the time per iteration comes from the optimisation
+        timer of the parent logger. The estimates are kept per task, so an instance can be shared between tasks.
+        :param target: Target fraction of the total time spent in the task.
+        :param min_gap: Minimum gap between firings (iterations or seconds).
+        :param max_gap: Maximum gap between firings (iterations or seconds).
+        :param start: First firing.
+        :param smoothing: Weight of the previous cost estimate when adding a firing (0 uses the last firing only).
+        """
+        self.target = target
+        self.min_gap = min_gap
+        self.max_gap = max_gap
+        self.start = start
+        self.smoothing = smoothing
+        self._costs = {}  # task -> (time_spent at the last firing, cost estimate)
+
+    def first_event(self, task):
+        return self.start
+
+    def _update_cost(self, task):
+        time_spent, cost = self._costs.get(task, (0.0, None))
+        last_cost = task.time_spent - time_spent
+        cost = last_cost if cost is None else self.smoothing * cost + (1.0 - self.smoothing) * last_cost
+        self._costs[task] = (task.time_spent, cost)
+        return cost
+
+    def next_event(self, task, logger):
+        """
+        Compute the next firing of `task`, which has just fired.
+        """
+        cost = self._update_cost(task)
+        if task._trigger == "iter":
+            time_per_iter = logger._opt_timer.elapsed_time / logger._i if logger._i > 0 else 0.0
+            if time_per_iter > 0.0:
+                gap = cost * (1.0 - self.target) / (self.target * time_per_iter)
+            else:
+                gap = self.min_gap
+            return logger._i + math.ceil(min(max(gap, self.min_gap), self.max_gap))
+        else:
+            gap = min(max(cost / self.target, self.min_gap), self.max_gap)
+            return logger._total_timer.elapsed_time + gap
@@ -0,0 +1,86 @@
+"""
+Compute tracker metrics after the optimisation, from the parameters stored in a history.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from .helpers import GPflowOptimisationHelper
+from .tasks import GPflowLogOptimisation
+
+
+def _stored_params(row):
+    params = row.filter(regex='model.*').to_dict()
+    if any(np.isscalar(v) and np.isnan(v) for v in params.values()):
+        return None  # Not stored, e.g. with `store_x="final_only"`
+    return params
+
+
+def _replay_chunk(model_factory, tracker_factory, rows):
+    """
+    Compute the records of a tracker for a list of `(label, i, f, params)` rows, with a freshly built model.
+    :return: List of `(label, record)`, where the record only contains the tracker's own columns.
+    """
+    model = model_factory()
+    tracker = tracker_factory()
+    helper = GPflowOptimisationHelper(model, [tracker])
+    base_columns = set(GPflowLogOptimisation._get_columns(tracker, helper))
+    records = []
+    for label, i, f, params in rows:
+        model.set_parameter_dict(params)
+        helper._i = i
+        x = model.get_free_state().copy()
+        # The objective and gradient in the record are discarded, so don't evaluate them.
+        helper._prev_x = x.copy()
+        helper._prev_val = (f, np.zeros_like(x))
+        record = tracker._get_record(helper, x)
+        records.append((label, dict((k, v) for k, v in record.items() if k not in base_columns)))
+    return records
+
+
+def replay_tracker(hist, model_factory, tracker_factory, iterations=None, num_workers=None):
+    """
+    Compute the metrics of a tracker (e.g. `gpflow_tasks.GPflowRegressionTracker`) for the iterations in a history
+    that was logged with `store_x=True`, and add them to the history as if the tracker had run during the optimisation.
+    Work is split over worker processes, each of which builds its own model and tracker. Workers are started with the
+    "spawn" method, as TensorFlow sessions in this process don't survive a fork. Only the tracker's own columns are
+    computed, the objective and gradient are not evaluated again.
+    :param hist: History with `model.*` columns.
+    :param model_factory: Function returning the model. Needs to be picklable, e.g. a module-level function or a
+                          `functools.partial`, if `num_workers > 1`.
+    :param tracker_factory: Function returning the tracker. Its sequence is not used, so it can be None.
+    :param iterations: Iterations (values of `i`) to compute the metrics for. Defaults to all rows with stored
+                       parameters.
+    :param num_workers: Number of worker processes. Defaults to the number of CPUs. With 1, runs in this process.
+    :return: Copy of `hist` with the tracker's columns added.
+    """
+    rows = []
+    for label, row in hist.iterrows():
+        if iterations is not None and row.i not in iterations:
+            continue
+        params = _stored_params(row)
+        if params is not None:
+            rows.append((label, row.i, row.f, params))
+
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    num_workers = max(1, min(num_workers, len(rows)))
+    chunks = [rows[n::num_workers] for n in range(num_workers)]
+    if num_workers == 1:
+        records = _replay_chunk(model_factory, tracker_factory, rows)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=context) as pool:
+            futures = [pool.submit(_replay_chunk, model_factory, tracker_factory, chunk) for chunk in chunks]
+            records = [r for future in futures for r in future.result()]
+
+    result = hist.copy()
+    if len(records) == 0:
+        return result
+    replayed = pd.DataFrame([r for _, r in records], index=[label for label, _ in records])
+    for column in replayed.columns:
+        values = replayed[column].reindex(result.index)
+        result[column] = values.combine_first(result[column]) if column in result.columns else values
+    return result
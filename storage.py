@@ -0,0 +1,488 @@
+"""
+On-disk storage of optimisation histories.
+"""
+import bz2
+import hashlib
+import json
+import lzma
+import os
+import pickle
+import struct
+import time
+import uuid
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+class WriteAheadLog(object):
+    """
+    Append-only log of history records. Each record is stored as a fixed-layout header (magic, payload length,
+    CRC32) followed by the pickled record. Records are flushed to the OS on every append, so they survive the process
+    being killed. `fsync` is called in batches, to also survive a crash of the machine.
+
+    The log starts with a header identifying the run (`run_id`), and the last iteration that is already stored
+    elsewhere (`base_i`). `checkpoint` drops the records once the history is durably stored, and `finish` marks the run
+    as finished, so that a new run doesn't take the records for its own.
+    """
+    _magic = b'OTWL'
+    _header = struct.Struct('<4sII')
+
+    def __init__(self, path, fsync_every=32, fsync_interval=10.0):
+        """
+        :param path: Path of the log file.
+        :param fsync_every: Number of appended records after which the log is synced to disk.
+        :param fsync_interval: Time (s) after which the log is synced to disk.
+        """
+        self.path = path
+        self._fsync_every = fsync_every
+        self._fsync_interval = fsync_interval
+        self._file = None
+        self._valid_end = None
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self.header = None
+        self.finished = False
+
+    @property
+    def run_id(self):
+        return self.header['run'] if self.header is not None else None
+
+    @property
+    def base_i(self):
+        return self.header['base_i'] if self.header is not None else -np.inf
+
+    def _frame(self, record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        return self._header.pack(self._magic, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def read(self):
+        """
+        Read all complete records. Reading stops at the first truncated or corrupt record, which is what a crash during
+        a write leaves behind.
+        :return: List of records, without the run header.
+        """
+        records = []
+        self._valid_end = 0
+        self.header = None
+        self.finished = False
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(self._header.size)
+                if len(header) < self._header.size:
+                    break
+                magic, length, crc = self._header.unpack(header)
+                payload = f.read(length)
+                if magic != self._magic or len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                record = pickle.loads(payload)
+                if isinstance(record, dict) and record.get('_wal') == 'finished':
+                    self.finished = True  # Not part of the valid end, so it is dropped when appending again
+                    continue
+                if isinstance(record, dict) and record.get('_wal') == 'header':
+                    self.header = record
+                else:
+                    records.append(record)
+                self._valid_end = f.tell()
+        return records
+
+    def append(self, record):
+        if self._file is None:
+            self._open()
+        self._file.write(self._frame(record))
+        self._file.flush()
+        self._valid_end = self._file.tell()
+        self._unsynced += 1
+        if self._unsynced >= self._fsync_every or time.time() - self._last_sync >= self._fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None and self._unsynced > 0:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """
+        Mark the run as finished, and close the log. Appending again reopens the run.
+        """
+        if self._file is None:
+            self._open()
+        self._file.write(self._frame({'_wal': 'finished'}))
+        self._unsynced += 1
+        self.close()
+        self.finished = True
+
+    def checkpoint(self, base_i):
+        """
+        Drop all records, after the history up to and including iteration `base_i` has been durably stored.
+        """
+        self._rewrite(self.run_id, base_i)
+
+    def reset(self):
+        """
+        Drop all records, and start a new run.
+        """
+        self.finished = False
+        self._rewrite(None, -np.inf)
+
+    def _rewrite(self, run_id, base_i):
+        self.close()
+        self.header = {'_wal': 'header', 'run': run_id if run_id is not None else uuid.uuid4().hex, 'base_i': base_i}
+        data = self._frame(self.header)
+        if self.finished:
+            data += self._frame({'_wal': 'finished'})
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._valid_end = len(self._frame(self.header))
+
+    def _open(self):
+        if self._valid_end is None:
+            self.read()
+        if self._valid_end == 0:
+            self._rewrite(None, -np.inf)
+        self._file = open(self.path, 'ab')
+        self._file.truncate(self._valid_end)  # Drop a partially written record from a previous crash
+        self.finished = False
+
+
+def write_pickle(hist, path):
+    """
+    Store a history as a pickle, atomically and synced to disk.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(hist, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+_columnar_magic = b'OTCOLS01'
+_columnar_align = 64
+
+
+def _encode_column(values):
+    """
+    Encode the values of a column as a single typed array if possible. Columns of equally shaped numeric arrays (as
+    stored for `x`, `g` or `model.*`) are stacked. Anything else is pickled.
+    :return: (kind, array or bytes, whether the cells were arrays)
+    """
+    values = np.asarray(values) if not isinstance(values, np.ndarray) else values
+    if values.dtype.kind in 'biufc':
+        return 'array', values, False
+    if len(values) > 0:
+        cells = [np.asarray(v) for v in values]
+        shape, dtype = cells[0].shape, cells[0].dtype
+        if dtype.kind in 'biufc' and all(c.shape == shape and c.dtype.kind in 'biufc' for c in cells):
+            arr = np.stack(cells)
+            return 'array', arr, any(isinstance(v, np.ndarray) for v in values)
+    return 'pickle', pickle.dumps(list(values), protocol=pickle.HIGHEST_PROTOCOL), False
+
+
+_compressors = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress)
+}
+
+
+def delta_encode(arr, keyframe_every=64, compression='zlib'):
+    """
+    Encode an array of rows (e.g. a parameter over iterations) as keyframes plus deltas. Every `keyframe_every`-th row
+    is stored as is, the others as the XOR of their bit pattern with the previous row, which is exactly invertible.
+    Parameters that barely change give deltas with mostly zero bytes. The bytes are grouped by significance and
+    compressed.
+    :param arr: Integer or float array, with rows along the first axis.
+    :param keyframe_every: Number of rows between keyframes.
+    :param compression: Compressor (zlib | bz2 | lzma).
+    :return: bytes
+    """
+    arr = np.ascontiguousarray(arr)
+    bits = arr.view('<u%i' % arr.dtype.itemsize).reshape(len(arr), int(np.prod(arr.shape[1:])))
+    deltas = bits.copy()
+    deltas[1:] ^= bits[:-1]
+    deltas[::keyframe_every] = bits[::keyframe_every]
+    shuffled = np.ascontiguousarray(deltas.view(np.uint8).reshape(-1, arr.dtype.itemsize).T)
+    return _compressors[compression][0](shuffled.tobytes())
+
+
+def delta_decode(data, dtype, shape, keyframe_every=64, compression='zlib'):
+    """
+    Inverse of `delta_encode`.
+    """
+    dtype = np.dtype(dtype)
+    nrows, ncols = shape[0], int(np.prod(shape[1:]))
+    shuffled = np.frombuffer(_compressors[compression][1](data), dtype=np.uint8).reshape(dtype.itemsize, nrows * ncols)
+    deltas = np.ascontiguousarray(shuffled.T).view('<u%i' % dtype.itemsize).reshape(nrows, ncols)
+    if nrows == 0:
+        return deltas.view(dtype).reshape(shape)
+    # Undo the XOR within each segment starting at a keyframe, using a prefix XOR over all rows.
+    prefix = np.bitwise_xor.accumulate(deltas, axis=0)
+    starts = np.arange(0, nrows, keyframe_every)
+    before = np.zeros((len(starts), deltas.shape[1]), dtype=deltas.dtype)
+    before[1:] = prefix[starts[1:] - 1]
+    bits = prefix ^ np.repeat(before, np.diff(np.append(starts, nrows)), axis=0)
+    return bits.view(dtype).reshape(shape)
+
+
+def write_columns(hist, path, compression=None, keyframe_every=64, float32=False):
+    """
+    Store a history in a columnar format: a small JSON header, followed by one contiguous, aligned array per column.
+    Columns can be read individually, and are memory-mapped, with `read_columns`. The file is written to a temporary
+    file first and then moved into place, so an interrupted write never leaves a corrupt history.
+
+    With `compression`, numeric columns are stored with `delta_encode` instead, which makes the file much smaller for
+    slowly changing parameters, but means they are decoded rather than memory-mapped when read.
+    :param hist: History (pandas DataFrame).
+    :param path: Path of the file.
+    :param compression: Compressor for numeric columns (zlib | bz2 | lzma). None stores them uncompressed.
+    :param keyframe_every: Number of rows between keyframes for compressed columns.
+    :param float32: Store compressed float64 columns as float32 (lossy). They are read back as float64.
+    """
+    if compression is not None and compression not in _compressors:
+        raise ValueError("Unknown value for compression: %s." % str(compression))
+    blocks = []
+    entries = []
+    offset = 0
+    for name, values in [('__index__', hist.index.values)] + [(c, hist[c].values) for c in hist.columns]:
+        kind, data, cells = _encode_column(values)
+        entry = {'name': name, 'kind': kind, 'cells': cells}
+        if kind == 'array' and compression is not None and data.dtype.kind in 'iuf':
+            entry.update(kind='delta', dtype=data.dtype.str, shape=list(data.shape), compression=compression,
+                         keyframe_every=keyframe_every)
+            if float32 and data.dtype == np.float64:
+                data = data.astype(np.float32)
+            entry.update(stored_dtype=data.dtype.str)
+            data = delta_encode(data, keyframe_every, compression)
+        elif kind == 'array':
+            data = np.ascontiguousarray(data)
+            entry.update(dtype=data.dtype.str, shape=list(data.shape))
+            data = data.tobytes()
+        entry.update(offset=offset, nbytes=len(data))
+        entries.append(entry)
+        blocks.append(data)
+        offset += -(-len(data) // _columnar_align) * _columnar_align
+
+    header = json.dumps({'nrows': len(hist), 'columns': entries}).encode()
+    data_start = -(-(len(_columnar_magic) + 8 + len(header)) // _columnar_align) * _columnar_align
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_columnar_magic + struct.pack('<Q', len(header)) + header)
+        for entry, data in zip(entries, blocks):
+            f.seek(data_start + entry['offset'])
+            f.write(data)
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_columnar_header(f):
+    magic = f.read(len(_columnar_magic))
+    if magic != _columnar_magic:
+        raise ValueError("Not a columnar history file.")
+    header_len, = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(header_len).decode())
+    data_start = -(-(len(_columnar_magic) + 8 + header_len) // _columnar_align) * _columnar_align
+    return header, data_start
+
+
+def read_columns(path, columns=None, mmap=True):
+    """
+    Read a history stored with `write_columns`. Only the requested columns are read from disk.
+    :param path: Path of the file.
+    :param columns: List of columns to read. Defaults to all columns.
+    :param mmap: Memory-map the uncompressed numeric columns instead of reading them into memory. The DataFrame refers
+                 to the mapped data without copying it, so these columns are read-only.
+    :return: pandas DataFrame
+    """
+    with open(path, 'rb') as f:
+        header, data_start = _read_columnar_header(f)
+        entries = {e['name']: e for e in header['columns']}
+        names = [e['name'] for e in header['columns'][1:]] if columns is None else list(columns)
+        missing = [c for c in names if c not in entries]
+        if len(missing) > 0:
+            raise KeyError("Columns not in history: %s" % ", ".join(missing))
+
+        data = {}
+        for name in ['__index__'] + names:
+            e = entries[name]
+            if e['kind'] == 'pickle':
+                f.seek(data_start + e['offset'])
+                values = pickle.loads(f.read(e['nbytes']))
+            elif e['kind'] == 'delta':
+                f.seek(data_start + e['offset'])
+                values = delta_decode(f.read(e['nbytes']), e['stored_dtype'], e['shape'], e['keyframe_every'],
+                                      e['compression']).astype(e['dtype'], copy=False)
+            elif e['nbytes'] == 0:
+                values = np.empty(e['shape'], dtype=e['dtype'])
+            elif mmap:
+                values = np.memmap(path, dtype=e['dtype'], mode='r', offset=data_start + e['offset'],
+                                   shape=tuple(e['shape']))
+            else:
+                f.seek(data_start + e['offset'])
+                values = np.frombuffer(f.read(e['nbytes']), dtype=e['dtype']).reshape(e['shape'])
+            if e['cells'] or (e['kind'] != 'pickle' and len(e['shape']) > 1):
+                values = list(values)
+            data[name] = values
+
+    index = pd.Index(data.pop('__index__'))
+    return pd.DataFrame(dict((name, pd.Series(values, index=index, dtype=object if isinstance(values, list) else None))
+                             for name, values in data.items()), index=index, columns=names, copy=not mmap)
+
+
+def is_columnar(path):
+    with open(path, 'rb') as f:
+        return f.read(len(_columnar_magic)) == _columnar_magic
+
+
+def load_history(path, columns=None):
+    """
+    Load a stored history, either pickled or in the columnar format.
+    :param path: Path of the file.
+    :param columns: List of columns to load. For the columnar format, the other columns are not read.
+    :return: pandas DataFrame
+    """
+    if is_columnar(path):
+        return read_columns(path, columns)
+    hist = pd.read_pickle(path)
+    return hist if columns is None else hist[list(columns)]
+
+
+def _update_digest(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update(b'ndarray' + obj.dtype.str.encode() + str(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (tuple, list)):
+        h.update(b'seq%i' % len(obj))
+        for o in obj:
+            _update_digest(h, o)
+    elif isinstance(obj, dict):
+        h.update(b'dict%i' % len(obj))
+        for k in sorted(obj.keys()):
+            _update_digest(h, k)
+            _update_digest(h, obj[k])
+    elif isinstance(obj, bytes):
+        h.update(b'bytes' + obj)
+    else:
+        h.update(type(obj).__name__.encode() + repr(obj).encode())
+
+
+def digest(obj):
+    """
+    Stable digest of (nested tuples, lists and dicts of) numpy arrays, strings and numbers.
+    """
+    h = hashlib.sha1()
+    _update_digest(h, obj)
+    return h.hexdigest()
+
+
+class EvaluationCache(object):
+    def __init__(self, path, identity, max_size=1e9, evict_to=0.8):
+        """
+        Persistent cache of objective evaluations, stored as one file per evaluation in a directory. Entries are keyed
+        by the digest of `identity` and the evaluated parameter vector. When the directory grows beyond `max_size`, the
+        least recently used entries are removed until it is below `evict_to * max_size`. Sizes and access times are
+        kept in memory, so entries written by other processes are only accounted for after reopening the cache.
+
+        `identity` has to capture everything the objective depends on apart from the parameter vector, e.g. the model
+        class, its data and its fixed parameters. Otherwise stale results are returned.
+        :param path: Cache directory, can be shared between runs and identities.
+        :param identity: Identity of the objective, e.g. a tuple of a name and the data arrays. See `digest`.
+        :param max_size: Maximum total size of the cache directory (bytes).
+        :param evict_to: Fraction of `max_size` to shrink the cache to when it is full.
+        """
+        self.path = path
+        self._base_identity = digest(identity)
+        self._identity = self._base_identity
+        self._max_size = max_size
+        self._evict_to = evict_to
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._index = {}  # path -> [last access time, size]
+        for p in [os.path.join(path, n) for n in os.listdir(path) if n.endswith('.pkl')]:
+            try:
+                self._index[p] = [os.path.getmtime(p), os.path.getsize(p)]
+            except OSError:
+                pass  # Removed by another process
+        self._size = sum(size for _, size in self._index.values())
+
+    def scope(self, identity):
+        """
+        Key the entries by `identity` in addition to the identity the cache was created with. Replaces any earlier
+        scope. Used by `helpers.GPflowOptimisationHelper` to add a digest of the model.
+        """
+        self._identity = digest((self._base_identity, identity))
+
+    def _entry_path(self, x):
+        return os.path.join(self.path, digest((self._identity, np.asarray(x, dtype=float))) + '.pkl')
+
+    def get(self, x):
+        """
+        :return: The stored evaluation at `x`, or None.
+        """
+        path = self._entry_path(x)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        now = time.time()
+        try:
+            os.utime(path, (now, now))  # Mark as recently used, for other processes
+        except OSError:
+            pass
+        if path in self._index:
+            self._index[path][0] = now
+        return value
+
+    def put(self, x, value):
+        path = self._entry_path(x)
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        if path in self._index:
+            self._size -= self._index[path][1]  # Overwritten
+        self._index[path] = [time.time(), size]
+        self._size += size
+        if self._size > self._max_size:
+            self._evict()
+
+    def wrap(self, fun):
+        """
+        :return: Function evaluating `fun`, unless the evaluation is already in the cache.
+        """
+        def cached(x):
+            value = self.get(x)
+            if value is None:
+                value = fun(x)
+                self.put(x, value)
+            return value
+        return cached
+
+    def _evict(self):
+        for p in sorted(self._index, key=lambda p: self._index[p][0]):
+            if self._size <= self._evict_to * self._max_size:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                pass  # Removed by another process
+            self._size -= self._index.pop(p)[1]
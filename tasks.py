@@ -1,35 +1,87 @@
 import itertools
+import json
+import os
+import socket
+import socketserver
+import stat
 import sys
+import threading
 import time
+import tracemalloc
 import warnings
 
 import numpy as np
 import pandas as pd
 
+from . import storage
+
 
 class OptimisationIterationEvent(object):
     def __init__(self, sequence, trigger="iter"):
         self._seq = sequence
         self._trigger = trigger
-        self._next = next(self._seq) if self._seq is not None else np.inf
+        if self._seq is None:
+            self._next = np.inf
+        elif hasattr(self._seq, 'first_event'):
+            self._next = self._seq.first_event(self)
+        else:
+            self._next = next(self._seq)
+        self.time_spent = 0.0  # Total time spent in the event handler
+        self.max_time = 0.0  # Longest single call of the event handler
+        self.num_calls = 0
+        self.thread_safe = False
+        self.depends_on = []
 
     def setup(self, logger):
         pass
 
+    def concurrent(self, after=()):
+        """
+        Declare that this task is thread-safe, so the helper can run it concurrently with its neighbouring thread-safe
+        tasks. It is started only when the tasks in `after` have finished. Tasks that are not thread-safe keep running
+        in order, and wait for all tasks before them.
+        :param after: Tasks that need to finish before this task runs.
+        :return: self
+        """
+        self.thread_safe = True
+        self.depends_on = list(after)
+        return self
+
     def _event_handler(self, logger, x, final):
         raise NotImplementedError
 
-    def __call__(self, logger, x, final=False):
-        if ((self._trigger == "iter" and logger._i >= self._next) or
+    def _due(self, logger, final=False):
+        return ((self._trigger == "iter" and logger._i >= self._next) or
                 (self._trigger == "time" and logger._total_timer.elapsed_time >= self._next) or
-                final):
+                final)
+
+    def _advance(self, logger):
+        if self._seq is None:
+            return
+        if hasattr(self._seq, 'next_event'):
+            self._next = self._seq.next_event(self, logger)
+            return
+        self._next = next(self._seq)
+        for _ in range(1000000):
+            if self._next < (logger._i if self._trigger == "iter" else logger._total_timer.elapsed_time):
+                self._next = next(self._seq)
+            else:
+                break
+
+    def _handle(self, logger, x, final):
+        st = time.time()
+        try:
             self._event_handler(logger, x, final)
-            self._next = next(self._seq)
-            for _ in range(1000000):
-                if self._next < (logger._i if self._trigger == "iter" else logger._total_timer.elapsed_time):
-                    self._next = next(self._seq)
-                else:
-                    break
+        finally:
+            duration = time.time() - st
+            self.time_spent += duration
+            self.max_time = max(self.max_time, duration)
+            self.num_calls += 1
+
+    def __call__(self, logger, x, final=False):
+        if self._due(logger, final):
+            self._handle(logger, x, final)
+            self._advance(logger)
 
 
 class DisplayOptimisation(OptimisationIterationEvent):
@@ -58,21 +110,28 @@ class DisplayOptimisation(OptimisationIterationEvent):
 class LogOptimisation(OptimisationIterationEvent):
     hist_name = "hist"
 
-    def __init__(self, sequence, trigger="iter", old_hist=None, store_fullg=False, store_x=None, store_x_columns=None):
+    def __init__(self, sequence, trigger="iter", old_hist=None, store_fullg=False, store_x=None, store_x_columns=None,
+                 wal_path=None):
         """
         Log the optimisation history. Can also initialise the parent logger to a previously stored state by passing
         `old_hist`. The parent logger's iteration and timers will be set.
         :param sequence: Sequence of times when to log.
         :param trigger: Trigger type (time | iter)
-        :param old_hist: History to initialise with (pandas DataFrame).
+        :param old_hist: History to initialise with (pandas DataFrame), or the path of a stored history.
         :param store_fullg: Store the full gradient vector.
         :param store_x: Store the full parameter vector.
+        :param wal_path: Path of a write-ahead log. Every record is appended to it as soon as it is logged, and it is
+                         emptied whenever a `StoreOptimisationHistory` task has stored the history. If the log already
+                         exists, the records that are newer than `old_hist` are replayed into the history on setup,
+                         and the run resumes from there. A log of a finished run is only replayed when resuming from
+                         `old_hist`, otherwise it is discarded.
         """
         OptimisationIterationEvent.__init__(self, sequence, trigger)
         self._old_hist = old_hist
         self._store_fullg = store_fullg
         self._store_x = store_x
         self._store_x_columns = store_x_columns
+        self._wal = storage.WriteAheadLog(wal_path) if wal_path is not None else None
         self.resume_from_hist = True
 
     def setup(self, logger):
@@ -90,14 +149,62 @@ class LogOptimisation(OptimisationIterationEvent):
 
     def _setup_logger(self, logger):
         if self._old_hist is None:
-            self._set_hist(logger, pd.DataFrame(columns=self._get_columns(logger)))
+            hist = pd.DataFrame(columns=self._get_columns(logger))
+        elif isinstance(self._old_hist, str):
+            hist = storage.load_history(self._old_hist)
         else:
-            self._set_hist(logger, self._old_hist)
-            if self.resume_from_hist:
-                hist = self._get_hist(logger)
-                logger._i = hist.i.max()
-                logger._opt_timer.add_time(hist.t.max())
-                logger._total_timer.add_time(hist.tt.max())
+            hist = self._old_hist
+        if self._wal is not None:
+            hist = self._replay_wal(hist)
+        self._set_hist(logger, hist)
+        if len(hist) > 0 and self.resume_from_hist:
+            logger._i = hist.i.max()
+            logger._opt_timer.add_time(hist.t.max())
+            logger._total_timer.add_time(hist.tt.max())
+
+    def _replay_wal(self, hist):
+        """
+        Add the records from the write-ahead log that are not yet in `hist`. A record for the same iteration as the last
+        one replaces it, as in `_event_handler`.
+        """
+        records = self._wal.read()
+        if self._wal.finished and self._old_hist is None:
+            warnings.warn("Discarding the write-ahead log %s of finished run %s." % (self._wal.path, self._wal.run_id),
+                          RuntimeWarning)
+            self._wal.reset()
+            return hist
+        last_i = hist.i.max() if len(hist) > 0 else -np.inf
+        if last_i < self._wal.base_i:
+            raise ValueError("The write-ahead log %s only holds the records after iteration %i. Resume from the history "
+                             "stored then." % (self._wal.path, self._wal.base_i))
+        rows = []
+        for record in records:
+            if record['i'] < last_i:
+                continue
+            if len(rows) > 0 and rows[-1]['i'] == record['i']:
+                rows[-1] = record
+            else:
+                rows.append(record)
+        if len(rows) == 0:
+            return hist
+        if rows[0]['i'] == last_i:
+            hist = hist.iloc[:-1, :]
+        hist = hist.append(rows, ignore_index=True)
+        return self._drop_x(hist.iloc[:-1, :]).append(hist.iloc[-1:, :])
+
+    def _drop_x(self, hist):
+        """
+        Remove the stored parameters from the rows of `hist`, if they are only kept for the final row.
+        """
+        if self._store_x == "final_only":
+            columns = [c for c in hist.columns if 'model.' in c and
+                       (self._store_x_columns is None or c not in self._store_x_columns)]
+            if len(columns) > 0 and len(hist) > 0:
+                hist = hist.copy()
+                hist.loc[:, columns] = np.nan
+        elif self._store_x not in [True, None]:
+            raise ValueError("Unknown value for store_x: %s." % str(self._store_x))
+        return hist
 
     def _get_record(self, logger, x, f=None):
         if f is None:
@@ -125,16 +232,14 @@ class LogOptimisation(OptimisationIterationEvent):
         hist = self._get_hist(logger)
         if len(hist) > 0 and hist.iloc[-1, :].i == logger._i:
             hist = hist.iloc[:-1, :]
+        hist = self._drop_x(hist)
 
-        if self._store_x == "final_only":
-            if self._store_x_columns is None:
-                hist.iloc[:, ['model.' in c for c in hist.columns]] = np.nan
-            else:
-                hist.iloc[:, [c not in self._store_x_columns and 'model.' in c for c in hist.columns]] = np.nan
-        elif self._store_x not in [True, None]:
-            raise ValueError("Unknown value for store_x: %s." % str(self._store_x))
-
-        self._set_hist(logger, hist.append(self._get_record(logger, x), ignore_index=True))
+        record = self._get_record(logger, x)
+        self._set_hist(logger, hist.append(record, ignore_index=True))
+        if self._wal is not None:
+            self._wal.append(record)
+            if final:
+                self._wal.finish()
 
 
 class GPflowLogOptimisation(LogOptimisation):
@@ -142,9 +247,62 @@ class GPflowLogOptimisation(LogOptimisation):
     Log the optimisation progress of a GPflow object, and restore it from history.
     """
 
+    def __init__(self, sequence, trigger="iter", old_hist=None, store_fullg=False, store_x=None, store_x_columns=None,
+                 wal_path=None):
+        LogOptimisation.__init__(self, sequence, trigger, old_hist, store_fullg, store_x, store_x_columns, wal_path)
+        self._param_index = None
+
+    def setup(self, logger):
+        super(GPflowLogOptimisation, self).setup(logger)
+        self._param_index = self._build_param_index(logger.model)
+
     def _get_columns(self, logger):
         return ['i', 'feval', 't', 'tt', 'f', 'gnorm', 'g'] + list(logger.model.get_parameter_dict().keys())
 
+    @staticmethod
+    def _build_param_index(model):
+        """
+        Work out where every parameter of `model` lives in the free-state vector. Returns a list of
+        `(column, param, start, end)` tuples. Fixed parameters have `start = None` and are read from the model.
+        :param model: GPflow model.
+        :return: List of index entries, in the same order as `model.get_samples_df`.
+        """
+        index = []
+
+        def walk(parameterized):
+            for p in parameterized.sorted_params:
+                if hasattr(p, 'sorted_params'):
+                    walk(p)
+                elif p.fixed:
+                    index.append((p.long_name, p, None, None))
+                else:
+                    start, _ = model.get_param_index(p)
+                    index.append((p.long_name, p, start, start + p.size))
+
+        walk(model)
+        return index
+
+    def _param_index_valid(self, model, x):
+        if self._param_index is None or model._needs_recompile:
+            return False
+        free_size = sum(end - start for _, _, start, end in self._param_index if start is not None)
+        return free_size == len(x) and all((start is None) == p.fixed for _, p, start, _ in self._param_index)
+
+    def _get_param_record(self, logger, x):
+        """
+        Equivalent to `logger.model.get_samples_df(x[None, :]).iloc[0, :].to_dict()`, using the precomputed index.
+        The index is rebuilt when the free-state layout has changed, e.g. because a parameter was fixed.
+        """
+        if not self._param_index_valid(logger.model, x):
+            self._param_index = self._build_param_index(logger.model)
+        record = {}
+        for name, p, start, end in self._param_index:
+            if start is None:
+                record[name] = p.value
+            else:
+                record[name] = p.transform.forward(x[None, start:end].reshape((1,) + p.shape))[0]
+        return record
+
     def _setup_logger(self, logger):
         """
         _setup_logger
@@ -155,10 +313,10 @@ class GPflowLogOptimisation(LogOptimisation):
         :return: None
         """
         super(GPflowLogOptimisation, self)._setup_logger(logger)
-        if self._old_hist is not None and self.resume_from_hist:
-            logger.model.set_parameter_dict(self._old_hist.iloc[-1].filter(regex='model.*'))
+        hist = self._get_hist(logger)
+        if len(hist) > 0 and self.resume_from_hist:
+            logger.model.set_parameter_dict(hist.iloc[-1].filter(regex='model.*'))
             f, _ = logger._fg(logger.model.get_free_state())
-            hist = self._get_hist(logger)
 
             if not np.allclose(f, hist.iloc[-1].f):
                 warnings.warn(
@@ -176,29 +334,117 @@ class GPflowLogOptimisation(LogOptimisation):
              np.linalg.norm(g), g if self._store_fullg else 0.0)
         ))
         if self._store_x is not None:
-            log_dict.update(logger.model.get_samples_df(x[None, :].copy()).iloc[0, :].to_dict())
+            log_dict.update(self._get_param_record(logger, x))
+        if logger._opt_options is not None:
+            log_dict.update(logger._opt_options)
+        return log_dict
+
+
+class LogStochasticOptimisation(LogOptimisation):
+    def __init__(self, sequence, trigger="iter", full_sequence=None, full_trigger="iter", old_hist=None,
+                 store_fullg=False, store_x=None, store_x_columns=None, wal_path=None):
+        """
+        Log the progress of a `StochasticOptimisationHelper`. The `f` column holds the smoothed minibatch objective,
+        `f_mb` the last raw minibatch objective and `f_full` the full-data objective, which is only evaluated on the
+        (usually much sparser) `full_sequence`. Iterations where only the full objective is due are logged as well.
+        `samples` is the number of datapoints processed so far, and `samples/s` and `iter/s` are the rates since the
+        previously logged iteration.
+        :param sequence: Sequence of times when to log.
+        :param trigger: Trigger type (time | iter)
+        :param full_sequence: Sequence of times when to evaluate the full-data objective.
+        :param full_trigger: Trigger type for `full_sequence` (time | iter)
+        """
+        LogOptimisation.__init__(self, sequence, trigger, old_hist, store_fullg, store_x, store_x_columns, wal_path)
+        self._full_event = OptimisationIterationEvent(full_sequence, full_trigger)
+        self._full_due = False
+        self._f_full = np.nan
+        self._last_log = (0, 0.0, 0)  # Iteration, optimisation time and samples of the last logged row
+        self._rate_base = self._last_log  # Last logged row of an earlier iteration
+
+    def setup(self, logger):
+        LogOptimisation.setup(self, logger)
+        self._last_log = (logger._i, logger._opt_timer.elapsed_time, logger.num_samples)
+        self._rate_base = self._last_log
+
+    def _setup_logger(self, logger):
+        LogOptimisation._setup_logger(self, logger)
+        hist = self._get_hist(logger)
+        if len(hist) > 0 and self.resume_from_hist and 'samples' in hist.columns:
+            logger.num_samples = int(hist.samples.max())
+
+    def _get_columns(self, logger):
+        return ['i', 't', 'tt', 'f', 'f_mb', 'f_full', 'gnorm', 'samples', 'samples/s', 'iter/s', 'g', 'x']
+
+    def _get_record(self, logger, x, f=None):
+        f, g = logger._fg(x)
+        if logger._i != self._last_log[0]:
+            self._rate_base = self._last_log
+        self._last_log = (logger._i, logger._opt_timer.elapsed_time, logger.num_samples)
+        interval = self._last_log[1] - self._rate_base[1] + 1e-6
+        log_dict = dict(zip(
+            self._get_hist(logger).columns,
+            (logger._i, logger._opt_timer.elapsed_time, logger._total_timer.elapsed_time, f, logger.minibatch_f,
+             self._f_full, np.linalg.norm(g), logger.num_samples, (logger.num_samples - self._rate_base[2]) / interval,
+             (logger._i - self._rate_base[0]) / interval, g if self._store_fullg else 0.0,
+             x.copy() if self._store_x is not None else None)
+        ))
         if logger._opt_options is not None:
             log_dict.update(logger._opt_options)
         return log_dict
 
+    def _event_handler(self, logger, x, final, f=None):
+        self._f_full = logger.full_objective(x) if self._full_due else np.nan
+        LogOptimisation._event_handler(self, logger, x, final)
+
+    def __call__(self, logger, x, final=False):
+        self._full_due = self._full_event._due(logger, final)
+        if self._full_due:
+            self._full_event._advance(logger)
+            if not self._due(logger, final):
+                self._handle(logger, x, final)
+                return
+        LogOptimisation.__call__(self, logger, x, final)
+
 
 class StoreOptimisationHistory(OptimisationIterationEvent):
-    def __init__(self, store_path, sequence, trigger="time", verbose=False, hist_name="hist"):
+    def __init__(self, store_path, sequence, trigger="time", verbose=False, hist_name="hist", store_format="pickle",
+                 store_options=None):
         """
-        Stores the optimisation history present in the associated `logger` object.
+        Stores the optimisation history present in the associated `logger` object. If the logger has an evaluation
+        trace, it is stored alongside, at `store_path + ".trace"`. See `helpers.EvaluationTrace.store`. The history is
+        written atomically and synced to disk, after which the write-ahead logs of the history are emptied.
         :param store_path: Path to store the history.
         :param sequence: Sequence of times when to store.
         :param trigger: Trigger type (time | iter)
         :param verbose: Display when history is stored.
+        :param store_format: File format (pickle | columnar). See `storage.write_columns`.
+        :param store_options: Keyword arguments for `storage.write_columns`, e.g. `{'compression': 'zlib'}`. Only valid
+                              with the columnar format.
         """
         OptimisationIterationEvent.__init__(self, sequence, trigger)
         self._store_path = store_path
         self._verbose = verbose
         self.hist_name = hist_name
+        if store_format not in ["pickle", "columnar"]:
+            raise ValueError("Unknown value for store_format: %s." % str(store_format))
+        if store_options is not None and store_format != "columnar":
+            raise ValueError("store_options are only used with the columnar store_format.")
+        self._store_format = store_format
+        self._store_options = store_options if store_options is not None else {}
 
     def _event_handler(self, logger, x, final):
         st = time.time()
-        getattr(logger, self.hist_name).to_pickle(self._store_path)
+        hist = getattr(logger, self.hist_name)
+        if self._store_format == "columnar":
+            storage.write_columns(hist, self._store_path, **self._store_options)
+        else:
+            storage.write_pickle(hist, self._store_path)
+        for task in logger.tasks:
+            # The stored history holds every record in the write-ahead logs of this history
+            if isinstance(task, LogOptimisation) and task.hist_name == self.hist_name and task._wal is not None:
+                task._wal.checkpoint(hist.i.max() if len(hist) > 0 else -np.inf)
+        if getattr(logger, '_trace', None) is not None:
+            logger._trace.store(self._store_path + ".trace")
         store_time = time.time() - st
         if self._verbose:
             print("")
@@ -207,6 +453,131 @@ class StoreOptimisationHistory(OptimisationIterationEvent):
             warnings.warn("Storing history is taking long (%.2fs)." % store_time)
 
 
+def _to_json(obj):
+    """
+    Convert to plain JSON types. NaN and infinite values become None, as they are not valid JSON.
+    """
+    if isinstance(obj, dict):
+        return dict((str(k), _to_json(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in obj]
+    elif isinstance(obj, np.generic):
+        return _to_json(obj.item())
+    elif isinstance(obj, float):
+        return obj if np.isfinite(obj) else None
+    elif obj is None or isinstance(obj, (bool, int, str)):
+        return obj
+    return str(obj)
+
+
+class ProgressServer(OptimisationIterationEvent):
+    def __init__(self, socket_path, sequence, trigger="iter", num_rows=10, hist_name="hist"):
+        """
+        Serves the progress of the optimisation on a local Unix domain socket. Every connecting client receives a single
+        line of JSON with the iteration, timers, objective, per-task overhead and the most recent history rows. See
+        `query_progress`.
+
+        When triggered, the task only stores a snapshot. Clients are served from a background thread, which reads the
+        latest snapshot and never blocks the optimiser. The server is shut down and the socket removed when the task
+        fires with `final=True`, e.g. from `finish`. It is started again if the optimisation continues afterwards. Call
+        `close` to shut it down without finishing.
+        :param socket_path: Path of the socket. An existing socket at this path is removed, any other file raises a
+                            ValueError.
+        :param sequence: Sequence of times when to update the snapshot.
+        :param trigger: Trigger type (time | iter)
+        :param num_rows: Number of history rows to include.
+        :param hist_name: Name of the history to read from the parent logger.
+        """
+        OptimisationIterationEvent.__init__(self, sequence, trigger)
+        self._socket_path = socket_path
+        self._num_rows = num_rows
+        self.hist_name = hist_name
+        self._snapshot = {}
+        self._server = None
+
+    def setup(self, logger):
+        if self._server is not None:
+            return
+        if os.path.exists(self._socket_path):
+            if not stat.S_ISSOCK(os.stat(self._socket_path).st_mode):
+                raise ValueError("%s exists and is not a socket." % self._socket_path)
+            os.remove(self._socket_path)
+
+        task = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                snapshot = task._snapshot  # Snapshots are replaced, never modified.
+                hist = snapshot.get('hist', None)
+                if hist is not None:
+                    snapshot = dict(snapshot, hist=hist.to_dict('records'))
+                self.wfile.write((json.dumps(_to_json(snapshot), allow_nan=False) + "\n").encode())
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self._server = Server(self._socket_path, Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+    def _event_handler(self, logger, x, final):
+        if final:
+            self.close()
+            return
+        if self._server is None:
+            self.setup(logger)
+
+        snapshot = {
+            'i': logger._i,
+            't': logger._opt_timer.elapsed_time,
+            'tt': logger._total_timer.elapsed_time,
+            'timestamp': time.time(),
+            'tasks': [{'task': type(task).__name__, 'time': task.time_spent, 'calls': task.num_calls}
+                      for task in logger.tasks if isinstance(task, OptimisationIterationEvent)]
+        }
+        hist = getattr(logger, self.hist_name, None)
+        if hist is not None and len(hist) > 0:
+            snapshot['f'] = hist.f.iloc[-1]
+            snapshot['gnorm'] = hist.gnorm.iloc[-1]
+            snapshot['hist'] = hist.iloc[-self._num_rows:, :].copy()
+        else:
+            f, g = logger._fg(x)
+            snapshot['f'] = f
+            snapshot['gnorm'] = np.linalg.norm(g)
+        self._snapshot = snapshot
+
+
+def query_progress(socket_path, timeout=5.0):
+    """
+    Read the progress of an optimisation served by a `ProgressServer`.
+    :param socket_path: Path of the socket.
+    :param timeout: Socket timeout (s).
+    :return: dict
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(socket_path)
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        s.close()
+    return json.loads(data.decode())
+
+
 class OptimisationTimeout(Exception):
     pass
 
@@ -230,3 +601,183 @@ class Timeout(OptimisationIterationEvent):
             self._triggered = True
             logger.finish(x)
             raise OptimisationTimeout()
+
+
+class DeadlineTimeout(Timeout):
+    def __init__(self, deadline, safety=1.5, essential=None, costs=None, default_cost=0.0):
+        """
+        Stops the optimisation so that finishing completes before a hard deadline on the total running time. The time
+        needed to finish is estimated from the longest earlier firing of every task, and the longest iteration seen so
+        far. Tasks that haven't fired yet are estimated with `costs`, or `default_cost`. The tasks are finished through
+        the helper's `finish`, so in order and concurrently where declared. If there turns out not to be enough time,
+        time is reserved for the essential tasks, and any other task whose estimated cost doesn't fit in the time left
+        is skipped. Raises an OptimisationTimeout exception.
+        :param deadline: Hard limit on the total running time (s).
+        :param safety: Factor to multiply the estimated task costs with.
+        :param essential: Tasks, or task classes, that are always run. Defaults to `StoreOptimisationHistory`.
+        :param costs: Estimated cost (s) of tasks that haven't fired yet. Dict from tasks, or task classes, to seconds.
+        :param default_cost: Estimated cost (s) of the other tasks that haven't fired yet. A warning is given when such
+                             a task is finished without an estimate.
+        """
+        Timeout.__init__(self, deadline, "time")
+        self._deadline = deadline
+        self._safety = safety
+        self._essential = essential if essential is not None else [StoreOptimisationHistory]
+        self._costs = costs if costs is not None else {}
+        self._default_cost = default_cost
+        self._last_check = None
+        self._max_iter_time = 0.0
+        self.skipped = []
+
+    @staticmethod
+    def _matches(task, entries):
+        return [e for e in entries if task is e or (isinstance(e, type) and isinstance(task, e))]
+
+    def _is_essential(self, task):
+        return len(self._matches(task, self._essential)) > 0
+
+    def _has_estimate(self, task):
+        return getattr(task, 'num_calls', 0) > 0 or len(self._matches(task, self._costs)) > 0
+
+    def _cost(self, task):
+        if getattr(task, 'num_calls', 0) > 0:
+            cost = task.max_time
+        else:
+            matches = self._matches(task, self._costs)
+            cost = self._costs[matches[0]] if len(matches) > 0 else self._default_cost
+        return cost * self._safety
+
+    def _finish_tasks(self, logger):
+        return [task for task in logger.tasks if task is not self]
+
+    def __call__(self, logger, x, final=False):
+        if self._triggered or final:
+            return
+        now = logger._total_timer.elapsed_time
+        if self._last_check is not None:
+            self._max_iter_time = max(self._max_iter_time, now - self._last_check)
+        self._last_check = now
+
+        finish_cost = sum(self._cost(task) for task in self._finish_tasks(logger))
+        if now + finish_cost + self._max_iter_time >= self._deadline:
+            self._triggered = True
+            self._finish(logger, x)
+            raise OptimisationTimeout()
+
+    def _finish(self, logger, x):
+        tasks = self._finish_tasks(logger)
+        unknown = [task for task in tasks if not self._has_estimate(task)]
+        if len(unknown) > 0:
+            warnings.warn("No measured or estimated cost for finishing %s, assuming %.2fs." %
+                          (", ".join(type(task).__name__ for task in unknown), self._default_cost), RuntimeWarning)
+        costs = dict((id(task), self._cost(task)) for task in tasks)
+        reserve = [sum(costs[id(task)] for task in tasks if self._is_essential(task))]
+
+        def skip(task):
+            if task is self:
+                return True
+            cost = costs[id(task)]
+            if self._is_essential(task):
+                reserve[0] -= cost
+                return False
+            if self._deadline - logger._total_timer.elapsed_time - reserve[0] >= cost:
+                return False
+            self.skipped.append(task)
+            return True
+
+        logger.finish(x, skip)
+        if len(self.skipped) > 0:
+            warnings.warn("Skipped finishing %s to meet the deadline." %
+                          ", ".join(type(task).__name__ for task in self.skipped), RuntimeWarning)
+
+
+class OptimisationMemoryLimit(OptimisationTimeout):
+    pass
+
+
+def _current_rss():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return np.nan
+
+
+def _peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports kilobytes
+
+
+class MemoryUsage(OptimisationIterationEvent):
+    def __init__(self, sequence, trigger="time", max_rss=None, on_exceed="warn", num_allocations=0,
+                 hist_name="memory_hist"):
+        """
+        Records the memory usage of the process: `rss`, `peak_rss` and the in-memory size of the optimisation history
+        `hist_size` (bytes), and optionally the largest allocation sites from `tracemalloc` in `top_allocations`. By
+        default, the samples go to a separate history `memory_hist`, with their own `i`, `t` and `tt`. If `hist_name`
+        is the history of a logging task (e.g. "hist"), the columns are only added to the rows it logged for the current
+        iteration, and other samples are not recorded. Place this task after the logging task in that case.
+        :param sequence: Sequence of times when to sample.
+        :param trigger: Trigger type (time | iter)
+        :param max_rss: Maximum RSS (bytes).
+        :param on_exceed: What to do when `max_rss` is exceeded (warn | stop). "stop" finishes the optimisation, and
+                          raises an OptimisationMemoryLimit exception, which is an OptimisationTimeout.
+        :param num_allocations: Number of allocation sites to record. Starts `tracemalloc`, which slows down Python.
+        :param hist_name: Name of the history to record to.
+        """
+        OptimisationIterationEvent.__init__(self, sequence, trigger)
+        if on_exceed not in ["warn", "stop"]:
+            raise ValueError("Unknown value for on_exceed: %s." % str(on_exceed))
+        self._max_rss = max_rss
+        self._on_exceed = on_exceed
+        self._num_allocations = num_allocations
+        self.hist_name = hist_name
+        self._own_hist = False
+        self._triggered = False
+
+    def setup(self, logger):
+        if not hasattr(logger, self.hist_name):
+            setattr(logger, self.hist_name, pd.DataFrame(columns=['i', 't', 'tt']))
+            self._own_hist = True
+        if self._num_allocations > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _sample(self, logger):
+        hist = getattr(logger, LogOptimisation.hist_name, None)
+        record = {
+            'rss': _current_rss(),
+            'peak_rss': _peak_rss(),
+            'hist_size': hist.memory_usage(index=True, deep=True).sum() if hist is not None else 0
+        }
+        if self._num_allocations > 0:
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:self._num_allocations]
+            record['top_allocations'] = "\n".join(str(stat) for stat in stats)
+        return record
+
+    def _event_handler(self, logger, x, final):
+        record = self._sample(logger)
+        hist = getattr(logger, self.hist_name)
+        if self._own_hist:
+            record.update({'i': logger._i, 't': logger._opt_timer.elapsed_time, 'tt': logger._total_timer.elapsed_time})
+            setattr(logger, self.hist_name, hist.append(record, ignore_index=True))
+        elif len(hist) > 0 and hist.iloc[-1, :].i == logger._i:
+            for k, v in record.items():
+                hist.loc[hist.index[-1], k] = v
+
+        if self._max_rss is not None and record['rss'] > self._max_rss and not final:
+            if self._on_exceed == "warn":
+                warnings.warn("Memory usage (%.0fMB) exceeds the limit (%.0fMB)." %
+                              (record['rss'] / 2.0 ** 20, self._max_rss / 2.0 ** 20), RuntimeWarning)
+            elif not self._triggered:
+                self._triggered = True
+                logger.finish(x)
+                raise OptimisationMemoryLimit()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+import scipy.optimize as opt
+
+sys.path.append('..')
+import opt_tools as ot
+from opt_tools import deprecated
+
+
+def rosen_fg(x):
+    return opt.rosen(x), opt.rosen_der(x)
+
+
+class TestDeprecatedHelper(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.dir, 'hist.pkl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hist(self):
+        optlog = deprecated.OptimisationHelper(rosen_fg, hist_sequence=ot.seq_exp_lin(1.0, 1.0), store_x=True)
+        x = np.array([-1.0, 1.0])
+        for _ in range(3):
+            time.sleep(0.1)  # Time outside of the callback counts towards `t`
+            optlog.callback(x)
+        hist = optlog.hist
+        self.assertTrue(list(hist.columns) == ['i', 't', 'f', 'gnorm', 'g', 'x'])
+        self.assertTrue(list(hist.i) == [1, 2, 3])
+        self.assertTrue(np.all(hist.f == opt.rosen(x)))
+        self.assertTrue(np.all(np.diff(hist.t.astype(float)) >= 0.1))
+        self.assertTrue(hist.t.iloc[-1] <= optlog._total_timer.elapsed_time)
+        self.assertTrue(np.all(hist.x.iloc[-1] == x))
+
+        optlog.callback(x)
+        optlog.finish(x)  # Keeps the record of the last iteration
+        self.assertTrue(list(optlog.hist.i) == [1, 2, 3, 4])
+
+    def test_store_at_finish(self):
+        optlog = deprecated.OptimisationHelper(rosen_fg, store_path=self.store_path)
+        x = np.array([-1.0, 1.0])
+        optlog.callback(x)
+        self.assertFalse(os.path.exists(self.store_path))
+        optlog.finish(x)
+        stored = pd.read_pickle(self.store_path)
+        self.assertTrue(list(stored.i) == list(optlog.hist.i))
+
+    def run_until_timeout(self, optlog, x):
+        with self.assertRaises(KeyboardInterrupt):
+            for _ in range(100):
+                optlog.callback(x)
+                time.sleep(0.05)
+
+    def test_timeout_resume(self):
+        x = np.array([-1.0, 1.0])
+        optlog = deprecated.OptimisationHelper(rosen_fg, timeout=0.2, store_path=self.store_path)
+        self.run_until_timeout(optlog, x)
+        stored = pd.read_pickle(self.store_path)  # Stored by `finish` on timeout
+        self.assertTrue(stored.i.iloc[-1] == optlog._i)
+        self.assertTrue(stored.t.iloc[-1] >= 0.2)
+
+        resumed = deprecated.OptimisationHelper(rosen_fg, timeout=0.2, store_path=self.store_path, hist=stored)
+        self.assertTrue(resumed._i == optlog._i)
+        resumed.callback(x)  # The timeout is relative to the resumed history
+        st = time.time()
+        self.run_until_timeout(resumed, x)
+        self.assertTrue(time.time() - st >= 0.1)
+        self.assertTrue(resumed.hist.t.iloc[-1] >= stored.t.iloc[-1] + 0.2)
+
@@ -0,0 +1,41 @@
+import sys
+import unittest
+
+import numpy as np
+import scipy.optimize as opt
+
+sys.path.append('..')
+import opt_tools as ot
+
+
+class TestFiniteDifferenceGradient(unittest.TestCase):
+    def test_gradient(self):
+        x = np.array([-1.0, 1.0, 0.5])
+        for method in ["central", "forward"]:
+            g = ot.FiniteDifferenceGradient(opt.rosen, method=method)(x)
+            self.assertTrue(np.allclose(g, opt.rosen_der(x), rtol=1e-4, atol=1e-4))
+
+    def test_process_pool(self):
+        fd = ot.FiniteDifferenceGradient(opt.rosen, executor="process", num_workers=2)
+        x = np.array([-1.0, 1.0])
+        self.assertTrue(np.allclose(fd(x), opt.rosen_der(x), rtol=1e-4, atol=1e-4))
+        fd.close()
+
+    def test_helper(self):
+        optlog = ot.OptimisationHelper(
+            opt.rosen,
+            [ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0))],
+            g=ot.FiniteDifferenceGradient(opt.rosen, method="forward")
+        )
+        r = opt.minimize(optlog._fg, x0=np.array([-1.0, 1.0]), jac=True, method='L-BFGS-B', callback=optlog.callback)
+        self.assertTrue(np.allclose(r.x, [1.0, 1.0], atol=1e-3))
+        self.assertTrue(optlog.hist.gnorm.iloc[0] > 0.0)
+
+    def test_finish(self):
+        fd = ot.FiniteDifferenceGradient(opt.rosen, num_workers=2)
+        optlog = ot.OptimisationHelper(opt.rosen, [ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0))], g=fd)
+        x = np.array([-1.0, 1.0])
+        optlog._fg(x)
+        self.assertTrue(fd._pool is not None)
+        optlog.finish(x)
+        self.assertTrue(fd._pool is None)  # The pool is shut down with the helper
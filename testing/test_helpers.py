@@ -1,4 +1,7 @@
+import functools
+import shutil
 import sys
+import tempfile
 import time
 import unittest
 
@@ -9,6 +12,15 @@ import gpflow
 
 sys.path.append('..')
 import opt_tools as ot
+from opt_tools import deprecated
+
+
+def make_sgpr(X, Y):
+    return gpflow.sgpr.SGPR(X, Y, gpflow.kernels.RBF(1), X[:3, :].copy())
+
+
+def make_tracker(X, Y):
+    return ot.gpflow_tasks.GPflowRegressionTracker(X, Y, None)
 
 
 class TestGPflowHelper(unittest.TestCase):
@@ -48,3 +60,85 @@ class TestGPflowHelper(unittest.TestCase):
         f3, g3 = self.optlog._fg(x.copy() + 0.1)
         self.assertTrue(t2 != f3)
         self.assertTrue(np.all(g2 != g3))
+
+    def test_cache(self):
+        X, Y = self.optlog.model.X.value, self.optlog.model.Y.value
+        cache_dir = tempfile.mkdtemp()
+        try:
+            num_fevals = []
+            for fixed in [False, False, True]:
+                model = gpflow.sgpr.SGPR(X, Y, gpflow.kernels.RBF(1), X[:3, :].copy())
+                model.likelihood.variance.fixed = fixed
+                cache = ot.storage.EvaluationCache(cache_dir, 'sgpr')
+                optlog = ot.GPflowOptimisationHelper(model, [], cache=cache)
+                optlog.optimize(disp=False, maxiter=5)
+                num_fevals.append(model.num_fevals)
+            self.assertTrue(num_fevals[0] > 0)
+            self.assertTrue(num_fevals[1] == 0)  # All evaluations of the optimiser come from the cache
+            self.assertTrue(num_fevals[2] > 0)  # Different model, as a parameter is fixed
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_param_record(self):
+        log_task = self.optlog.tasks[1]
+        x = self.optlog.model.get_free_state().copy() + 0.1
+        fast = log_task._get_param_record(self.optlog, x)
+        slow = self.optlog.model.get_samples_df(x[None, :].copy()).iloc[0, :].to_dict()
+        self.assertTrue(set(fast.keys()) == set(slow.keys()))
+        for k in slow.keys():
+            self.assertTrue(np.allclose(fast[k], slow[k]))
+
+        # Fixing a parameter changes the free-state layout
+        self.optlog.model.kern.variance.fixed = True
+        self.optlog.model._compile()
+        x = self.optlog.model.get_free_state().copy() + 0.1
+        fast = log_task._get_param_record(self.optlog, x)
+        slow = self.optlog.model.get_samples_df(x[None, :].copy()).iloc[0, :].to_dict()
+        for k in slow.keys():
+            self.assertTrue(np.allclose(fast[k], slow[k]))
+
+    def test_replay_tracker(self):
+        X, Y = self.optlog.model.X.value, self.optlog.model.Y.value
+        self.optlog.model.optimize(callback=self.optlog.callback, disp=False, maxiter=5)
+        hist = self.optlog.hist
+
+        models = []
+
+        def model_factory():
+            models.append(gpflow.sgpr.SGPR(X, Y, gpflow.kernels.RBF(1), X[:3, :].copy()))
+            return models[-1]
+
+        def tracker_factory():
+            return ot.gpflow_tasks.GPflowRegressionTracker(X, Y, None)
+
+        replayed = ot.offline.replay_tracker(hist, model_factory, tracker_factory, num_workers=1)
+        self.assertTrue(len(replayed) == len(hist))
+        self.assertTrue(np.all(np.isfinite(replayed.rmse.astype(float))))
+        self.assertTrue(np.all(replayed.f == hist.f))
+        self.assertTrue(models[0].num_fevals == 0)  # The objective isn't evaluated again
+
+    def test_replay_tracker_processes(self):
+        X, Y = self.optlog.model.X.value, self.optlog.model.Y.value
+        self.optlog.model.optimize(callback=self.optlog.callback, disp=False, maxiter=5)
+        hist = self.optlog.hist
+
+        single = ot.offline.replay_tracker(hist, functools.partial(make_sgpr, X, Y),
+                                           functools.partial(make_tracker, X, Y), num_workers=1)
+        multi = ot.offline.replay_tracker(hist, functools.partial(make_sgpr, X, Y),
+                                          functools.partial(make_tracker, X, Y), num_workers=2)
+        self.assertTrue(list(multi.index) == list(hist.index))
+        self.assertTrue(np.allclose(multi.rmse.astype(float), single.rmse.astype(float)))
+
+
+class TestDeprecatedGPflowHelper(unittest.TestCase):
+    def test_param_hist(self):
+        X = np.linspace(0, 5, 100)[:, None]
+        Y = 0.3 * np.sin(2 * X) + 0.05 * rnd.randn(*X.shape)
+        model = gpflow.sgpr.SGPR(X, Y, gpflow.kernels.RBF(1), X[:3, :].copy())
+        optlog = deprecated.GPflowOptimisationHelper(model, hist_sequence=ot.seq_exp_lin(1.0, 1.0))
+        model.optimize(callback=optlog.callback, disp=False, maxiter=5)
+        hist = optlog.hist
+        self.assertTrue(list(hist.columns) == ['i', 't', 'f', 'gnorm', 'g'] + list(model.get_parameter_dict().keys()))
+        self.assertTrue(list(optlog.param_hist.columns) == list(model.get_parameter_dict().keys()))
+        self.assertTrue(len(optlog.param_hist) == optlog._i)
+        self.assertTrue(np.all(np.isfinite(hist.f.astype(float))))
@@ -0,0 +1,255 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+import scipy.optimize as opt
+
+sys.path.append('..')
+import opt_tools as ot
+
+
+def rosen_fg(x):
+    return [opt.rosen(x), opt.rosen_der(x)]
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.wal_path = os.path.join(self.dir, 'hist.wal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_helper(self, old_hist=None, store_x=True, store_path=None):
+        log_tasks = [ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0), old_hist=old_hist, store_x=store_x,
+                                              wal_path=self.wal_path)]
+        if store_path is not None:
+            log_tasks.append(ot.tasks.StoreOptimisationHistory(store_path, ot.seq_exp_lin(1.0, 5.0, 5.0, 5.0), "iter"))
+        return ot.OptimisationHelper(rosen_fg, log_tasks)
+
+    def optimise(self, optlog, num_iters, x=None):
+        x = np.array([-1.0, 1.0]) if x is None else x
+        for _ in range(num_iters):
+            x = x - 1e-3 * rosen_fg(x)[1]
+            optlog.callback(x)
+        return x
+
+    def test_replay(self):
+        optlog = self.make_helper()
+        x = np.array([-1.0, 1.0])
+        for _ in range(10):
+            x = x - 1e-3 * rosen_fg(x)[1]
+            optlog.callback(x)
+        optlog.tasks[0]._wal.close()
+        stored = optlog.hist.iloc[:4, :]
+
+        # Resume from an out-of-date stored history, after the process has "crashed" partway through a write.
+        with open(self.wal_path, 'ab') as f:
+            f.write(b'OTWL\x10\x00')
+        resumed = self.make_helper(stored)
+        self.assertTrue(resumed._i == 10)
+        self.assertTrue(len(resumed.hist) == 10)
+        self.assertTrue(np.allclose(resumed.hist.f.astype(float), optlog.hist.f.astype(float)))
+        self.assertTrue(np.all(resumed.hist.x.iloc[-1] == x))
+
+        resumed.callback(x)
+        resumed.tasks[0]._wal.close()
+        self.assertTrue(len(ot.storage.WriteAheadLog(self.wal_path).read()) == 11)
+
+    def test_checkpoint(self):
+        store_path = os.path.join(self.dir, 'hist.pkl')
+        optlog = self.make_helper(store_path=store_path)
+        x = self.optimise(optlog, 7)
+        wal = ot.storage.WriteAheadLog(self.wal_path)
+        self.assertTrue(len(wal.read()) == 2)  # Stored at iteration 5
+        self.assertTrue(wal.base_i == 5)
+        run_id = wal.run_id
+
+        # The log only holds the records after the stored history
+        with self.assertRaises(ValueError):
+            self.make_helper()
+        resumed = self.make_helper(store_path, store_path=store_path)
+        self.assertTrue(resumed._i == 7)
+        self.assertTrue(np.all(resumed.hist.x.iloc[-1] == x))
+        self.optimise(resumed, 5, x)
+        wal = ot.storage.WriteAheadLog(self.wal_path)
+        self.assertTrue([r['i'] for r in wal.read()] == [11, 12])
+        self.assertTrue(wal.run_id == run_id)
+
+    def test_finished(self):
+        optlog = self.make_helper()
+        x = self.optimise(optlog, 3)
+        optlog.finish(x)
+        self.assertTrue(optlog.tasks[0]._wal._file is None)  # Closed
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always", RuntimeWarning)
+            fresh = self.make_helper()
+        self.assertTrue(fresh._i == 0 and len(fresh.hist) == 0)
+        self.assertTrue(any("finished" in str(warning.message) for warning in w))
+        self.optimise(fresh, 2)
+        self.assertTrue([r['i'] for r in ot.storage.WriteAheadLog(self.wal_path).read()] == [1, 2])
+
+        # Resuming a finished run replays the log, and continues it
+        resumed = self.make_helper(optlog.hist.iloc[:0, :])
+        self.assertTrue(resumed._i == 2)
+
+    def test_final_only(self):
+        optlog = self.make_helper(store_x="final_only")
+        optlog._opt_options = {'model.a': 1.0}
+        self.optimise(optlog, 5)
+        optlog.tasks[0]._wal.close()
+        resumed = self.make_helper(optlog.hist.iloc[:2, :], store_x="final_only")
+        self.assertTrue(len(resumed.hist) == 5)
+        self.assertTrue(list(np.isfinite(resumed.hist['model.a'].astype(float))) == [False] * 4 + [True])
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hist.cols')
+        optlog = ot.OptimisationHelper(
+            rosen_fg,
+            [
+                ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0), store_fullg=True, store_x=True),
+                ot.tasks.StoreOptimisationHistory(self.path, ot.seq_exp_lin(1.0, 1.0), trigger="iter",
+                                                  store_format="columnar")
+            ]
+        )
+        x = np.array([-1.0, 1.0])
+        for _ in range(10):
+            x = x - 1e-3 * rosen_fg(x)[1]
+            optlog.callback(x)
+        self.hist = optlog.hist
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store_options(self):
+        with self.assertRaises(ValueError):
+            ot.tasks.StoreOptimisationHistory(self.path, None, store_options={'compression': 'zlib'})
+
+    def test_roundtrip(self):
+        hist = ot.storage.load_history(self.path)
+        self.assertTrue(list(hist.columns) == list(self.hist.columns))
+        self.assertTrue(np.all(hist.i.values == self.hist.i.values))
+        self.assertTrue(np.all(hist.f.values == self.hist.f.values.astype(float)))
+        self.assertTrue(np.all(np.vstack(hist.x) == np.vstack(self.hist.x)))
+        self.assertTrue(np.all(np.vstack(hist.g) == np.vstack(self.hist.g)))
+
+    def test_projection(self):
+        hist = ot.storage.read_columns(self.path, ['i', 'f'])
+        self.assertTrue(list(hist.columns) == ['i', 'f'])
+        self.assertTrue(np.all(hist.f.values == self.hist.f.values.astype(float)))
+        with self.assertRaises(KeyError):
+            ot.storage.read_columns(self.path, ['nonexistent'])
+
+    def test_resume(self):
+        optlog = ot.OptimisationHelper(rosen_fg, [ot.tasks.LogOptimisation(None, old_hist=self.path)])
+        self.assertTrue(optlog._i == 10)
+        self.assertTrue(optlog._total_timer.elapsed_time >= self.hist.tt.max())
+
+    def test_mmap(self):
+        def mapped(values):
+            while values is not None and not isinstance(values, np.memmap):
+                values = values.base
+            return values is not None
+
+        hist = ot.storage.read_columns(self.path)
+        self.assertTrue(mapped(hist.f.values) and mapped(hist.i.values))
+        self.assertFalse(hist.f.values.flags.writeable)
+        self.assertTrue(np.all(hist.f.values == self.hist.f.values.astype(float)))
+        hist = ot.storage.read_columns(self.path, mmap=False)
+        self.assertFalse(mapped(hist.f.values))
+        self.assertTrue(hist.f.values.flags.writeable)
+
+    def test_compression(self):
+        for options in [{'compression': 'zlib'}, {'compression': 'lzma', 'keyframe_every': 3}]:
+            ot.storage.write_columns(self.hist, self.path, **options)
+            hist = ot.storage.load_history(self.path)
+            self.assertTrue(np.all(hist.i.values == self.hist.i.values))
+            self.assertTrue(np.all(hist.f.values == self.hist.f.values.astype(float)))
+            self.assertTrue(np.all(np.vstack(hist.x) == np.vstack(self.hist.x)))
+
+        ot.storage.write_columns(self.hist, self.path, compression='zlib', float32=True)
+        hist = ot.storage.load_history(self.path)
+        self.assertTrue(hist.f.dtype == np.float64)
+        self.assertTrue(np.allclose(hist.f.values, self.hist.f.values.astype(float), rtol=1e-6))
+
+    def test_delta_size(self):
+        rnd = np.random.RandomState(0)
+        params = 1.0 + np.cumsum(1e-10 * rnd.randn(1000, 50), 0)
+        encoded = ot.storage.delta_encode(params)
+        self.assertTrue(len(encoded) < 0.5 * params.nbytes)
+        self.assertTrue(np.all(ot.storage.delta_decode(encoded, params.dtype, params.shape) == params))
+        empty = np.zeros((0, 3))
+        self.assertTrue(ot.storage.delta_decode(ot.storage.delta_encode(empty), empty.dtype, empty.shape).shape == (0, 3))
+
+
+class TestEvaluationCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.num_evals = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def counting_fg(self, x):
+        self.num_evals += 1
+        return rosen_fg(x)
+
+    def test_cache(self):
+        x = np.array([-1.0, 1.0])
+        for _ in range(2):
+            cache = ot.storage.EvaluationCache(self.dir, ('rosen', 2))
+            optlog = ot.OptimisationHelper(self.counting_fg, [], cache=cache)
+            f, g = optlog._fg(x)
+            self.assertTrue(f == opt.rosen(x))
+            self.assertTrue(np.all(g == opt.rosen_der(x)))
+        self.assertTrue(self.num_evals == 1)
+
+        cache = ot.storage.EvaluationCache(self.dir, ('rosen', 3))  # Different identity
+        ot.OptimisationHelper(self.counting_fg, [], cache=cache)._fg(x)
+        self.assertTrue(self.num_evals == 2)
+
+    def test_scope(self):
+        cache = ot.storage.EvaluationCache(self.dir, 'rosen')
+        x = np.array([-1.0, 1.0])
+        cache.put(x, rosen_fg(x))
+        cache.scope(('model', np.arange(3.0)))
+        self.assertTrue(cache.get(x) is None)
+        cache.put(x, rosen_fg(x))
+        cache.scope(('model', np.arange(3.0)))
+        self.assertTrue(cache.get(x) is not None)
+
+    def test_wrap(self):
+        cache = ot.storage.EvaluationCache(self.dir, 'rosen')
+        fg = cache.wrap(self.counting_fg)
+        x = np.array([-1.0, 1.0])
+        self.assertTrue(fg(x)[0] == fg(x.copy())[0] == opt.rosen(x))
+        self.assertTrue(self.num_evals == 1)
+
+    def test_eviction(self):
+        cache = ot.storage.EvaluationCache(self.dir, 'rosen', max_size=2000)
+        for i in range(50):
+            cache.put(np.array([float(i)]), (float(i), np.arange(10.0)))
+        self.assertTrue(sum(os.path.getsize(os.path.join(self.dir, n)) for n in os.listdir(self.dir)) <= 2000)
+        self.assertTrue(cache.get(np.array([49.0]))[0] == 49.0)
+        self.assertTrue(cache.get(np.array([0.0])) is None)
+
+    def test_eviction_batches(self):
+        cache = ot.storage.EvaluationCache(self.dir, 'rosen', max_size=20000)
+        evict, num_evictions = cache._evict, []
+        cache._evict = lambda: num_evictions.append(1) or evict()
+        for i in range(500):
+            cache.put(np.array([float(i)]), (float(i), np.arange(10.0)))
+        self.assertTrue(0 < len(num_evictions) < 50)
+
+        size = cache._size
+        cache.put(np.array([499.0]), (499.0, np.arange(10.0)))  # Overwriting doesn't grow the cache
+        self.assertTrue(cache._size == size)
+        self.assertTrue(sum(os.path.getsize(os.path.join(self.dir, n)) for n in os.listdir(self.dir)) == size)
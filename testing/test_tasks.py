@@ -0,0 +1,356 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+import warnings
+
+import numpy as np
+import numpy.random as rnd
+import scipy.optimize as opt
+
+sys.path.append('..')
+import opt_tools as ot
+
+
+class TestStochasticOptimisation(unittest.TestCase):
+    def setUp(self):
+        rnd.seed(0)
+        self.X = rnd.randn(1000, 2) + np.array([1.0, -2.0])
+
+    def minibatch_fg(self, x):
+        batch = self.X[rnd.randint(0, len(self.X), 10), :]
+        return [0.5 * np.sum((batch - x) ** 2.0) / len(batch), np.mean(x - batch, 0)]
+
+    def full_fg(self, x):
+        return [0.5 * np.sum((self.X - x) ** 2.0) / len(self.X), np.mean(x - self.X, 0)]
+
+    def test_logging(self):
+        optlog = ot.StochasticOptimisationHelper(
+            self.minibatch_fg,
+            [ot.tasks.LogStochasticOptimisation(ot.seq_exp_lin(1.0, 1.0), full_sequence=ot.seq_exp_lin(1.0, 50.0, 50.0))],
+            full_f=self.full_fg,
+            batch_size=10
+        )
+        x = optlog.optimize(np.zeros(2), lambda x, g: x - 0.1 * g, maxiter=200)
+        optlog.finish(x)
+
+        hist = optlog.hist
+        self.assertTrue(len(hist) == 200)
+        self.assertTrue(optlog.num_samples == 2000)
+        self.assertTrue(np.allclose(x, [1.0, -2.0], atol=0.3))
+        full = hist[np.isfinite(hist.f_full.astype(float))]
+        self.assertTrue(list(full.i) == [50, 100, 150, 200])
+        self.assertTrue(np.allclose(full.f_full.iloc[-1], self.full_fg(x)[0]))
+        self.assertTrue(np.all(hist['samples/s'] > 0.0))
+        # The smoothed objective is less noisy than the raw minibatch estimates
+        self.assertTrue(np.std(np.diff(hist.f.values[100:].astype(float))) <
+                        np.std(np.diff(hist.f_mb.values[100:].astype(float))))
+
+    def test_resume(self):
+        def make_helper(old_hist=None):
+            return ot.StochasticOptimisationHelper(
+                self.minibatch_fg,
+                [ot.tasks.LogStochasticOptimisation(ot.seq_exp_lin(1.0, 10.0, 10.0, 10.0), old_hist=old_hist)],
+                batch_size=10
+            )
+
+        def slow_step(x, g):
+            time.sleep(0.001)
+            return x - 0.1 * g
+
+        optlog = make_helper()
+        x = optlog.optimize(np.zeros(2), slow_step, maxiter=50)
+        time.sleep(0.2)  # Time outside of the optimisation doesn't count
+        resumed = make_helper(optlog.hist)
+        self.assertTrue(resumed.num_samples == 500)
+        resumed.optimize(x, slow_step, maxiter=50)
+        hist = resumed.hist
+        self.assertTrue(list(hist.samples) == list(range(100, 501, 100)) + [510] + list(range(600, 1001, 100)))
+        rates = hist['samples/s'].values.astype(float)
+        self.assertTrue(np.allclose(rates, 10.0 * hist['iter/s'].values.astype(float)))
+        self.assertTrue(rates[6] > 0.5 * rates[4])  # Rates since the last row, so they don't restart after resuming
+
+
+class TestProgressServer(unittest.TestCase):
+    def test_query(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), 'progress.sock')
+        server = ot.tasks.ProgressServer(socket_path, ot.seq_exp_lin(1.0, 1.0), num_rows=3)
+        optlog = ot.OptimisationHelper(
+            lambda x: [opt.rosen(x), opt.rosen_der(x)],
+            [ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0), store_x=True), server]
+        )
+        try:
+            x = np.array([-1.0, 1.0])
+            for _ in range(5):
+                optlog.callback(x)
+            progress = ot.tasks.query_progress(socket_path)
+            self.assertTrue(progress['i'] == 5)
+            self.assertTrue(np.allclose(progress['f'], opt.rosen(x)))
+            self.assertTrue([r['i'] for r in progress['hist']] == [3, 4, 5])
+            self.assertTrue(progress['hist'][-1]['x'] == list(x))
+            self.assertTrue(progress['tasks'][0]['task'] == 'LogOptimisation')
+            self.assertTrue(progress['tasks'][0]['calls'] == 5)
+
+            optlog.finish(x)  # Shuts down the server
+            self.assertFalse(os.path.exists(socket_path))
+            for _ in range(2):
+                optlog.callback(x)  # Continuing starts it again
+            self.assertTrue(ot.tasks.query_progress(socket_path)['i'] == 7)
+        finally:
+            server.close()
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_strict_json(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), 'progress.sock')
+        server = ot.tasks.ProgressServer(socket_path, ot.seq_exp_lin(1.0, 1.0))
+        optlog = ot.OptimisationHelper(lambda x: [np.nan, np.zeros(2)],
+                                       [ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0)), server])
+        try:
+            optlog.callback(np.zeros(2))
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(socket_path)
+            data = client.makefile('rb').readline()
+            client.close()
+            progress = json.loads(data.decode(), parse_constant=self.fail)  # No NaN tokens
+            self.assertTrue(progress['f'] is None)
+            self.assertTrue(progress['hist'][-1]['f'] is None)
+        finally:
+            server.close()
+
+    def test_existing_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'hist.pkl')
+        with open(path, 'w') as f:
+            f.write("history")
+        with self.assertRaises(ValueError):
+            ot.OptimisationHelper(lambda x: [0.0, 0.0], [ot.tasks.ProgressServer(path, ot.seq_exp_lin(1.0, 1.0))])
+        with open(path) as f:
+            self.assertTrue(f.read() == "history")
+
+
+class SlowTask(ot.tasks.OptimisationIterationEvent):
+    delay = 0.02
+
+    def _event_handler(self, logger, x, final):
+        if self.delay > 0.0:
+            time.sleep(self.delay)
+
+
+class TestOverheadBudget(unittest.TestCase):
+    def test_overhead(self):
+        task = SlowTask(ot.OverheadBudget(0.05, min_gap=1, max_gap=1000))
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [task])
+        for _ in range(400):
+            time.sleep(0.002)
+            optlog.callback(np.zeros(1))
+        self.assertTrue(task.num_calls > 2)
+        self.assertTrue(task.time_spent / optlog._total_timer.elapsed_time < 0.1)
+
+    def test_slowdown(self):
+        budget = ot.OverheadBudget(0.05, min_gap=1, max_gap=1000)
+        task = SlowTask(budget)
+        task.delay = 0.0
+        fast = SlowTask(budget)  # Shared, the estimates are kept per task
+        fast.delay = 0.0
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [task, fast])
+        for _ in range(100):
+            time.sleep(0.002)
+            optlog.callback(np.zeros(1))
+
+        # The task gets slower, which is picked up from the last firings, rather than the mean over the whole run
+        task.delay = 0.02
+        time_spent, elapsed_time = task.time_spent, optlog._total_timer.elapsed_time
+        for _ in range(200):
+            time.sleep(0.002)
+            optlog.callback(np.zeros(1))
+        overhead = (task.time_spent - time_spent) / (optlog._total_timer.elapsed_time - elapsed_time)
+        self.assertTrue(overhead < 0.15)
+        self.assertTrue(fast.num_calls == 300)
+
+
+class TestDeadlineTimeout(unittest.TestCase):
+    def setUp(self):
+        self.store_path = os.path.join(tempfile.mkdtemp(), 'hist.pkl')
+
+    def run_until_timeout(self, slow_seq, deadline, **kwargs):
+        slow = SlowTask(slow_seq)
+        optlog = ot.OptimisationHelper(
+            lambda x: [0.0, 0.0],
+            [
+                ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0)),
+                slow,
+                ot.tasks.StoreOptimisationHistory(self.store_path, None),
+                ot.tasks.DeadlineTimeout(deadline, **kwargs)
+            ]
+        )
+        with self.assertRaises(ot.OptimisationTimeout):
+            while True:
+                time.sleep(0.01)
+                optlog.callback(np.zeros(1))
+        return optlog, slow
+
+    def test_deadline(self):
+        costs = {ot.tasks.StoreOptimisationHistory: 0.1}
+        optlog, slow = self.run_until_timeout(ot.seq_exp_lin(1.0, 10.0), 1.0, safety=3.0, costs=costs)
+        self.assertTrue(optlog._total_timer.elapsed_time < 1.0)
+        self.assertTrue(len(optlog.tasks[3].skipped) == 0)
+        self.assertTrue(os.path.exists(self.store_path))
+
+    def test_degrade(self):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always", RuntimeWarning)
+            optlog, slow = self.run_until_timeout(ot.seq_exp_lin(1.0, 10.0), 0.01)
+        self.assertTrue(slow in optlog.tasks[3].skipped)
+        self.assertTrue(slow.num_calls == 1)
+        self.assertTrue(os.path.exists(self.store_path))
+        self.assertTrue(any("deadline" in str(warning.message) for warning in w))
+
+    def test_unfired_costs(self):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always", RuntimeWarning)
+            costs = {SlowTask: 0.6, ot.tasks.StoreOptimisationHistory: 0.01}
+            optlog, slow = self.run_until_timeout(None, 1.0, costs=costs)
+        self.assertTrue(optlog._total_timer.elapsed_time < 0.5)  # Stopped early enough for the estimated 0.9s
+        self.assertTrue(slow.num_calls == 1)
+        self.assertFalse(any("No measured" in str(warning.message) for warning in w))
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always", RuntimeWarning)
+            self.run_until_timeout(None, 0.1)
+        self.assertTrue(any("No measured" in str(warning.message) for warning in w))
+
+    def test_finish_through_helper(self):
+        order = []
+        a = RecordingTask("a", order).concurrent()
+        b = RecordingTask("b", order).concurrent()
+        finished = []
+
+        class Helper(ot.OptimisationHelper):
+            def finish(self, x, skip=None):
+                finished.append(self._i)
+                ot.OptimisationHelper.finish(self, x, skip)
+
+        optlog = Helper(lambda x: [0.0, 0.0], [a, b, ot.tasks.DeadlineTimeout(0.5)])
+        with self.assertRaises(ot.OptimisationTimeout):
+            while True:
+                optlog.callback(np.zeros(1))
+        self.assertTrue(finished == [optlog._i])
+        self.assertTrue(order[-4:-2] == ["a-start", "b-start"] or order[-4:-2] == ["b-start", "a-start"])
+
+
+class TestMemoryUsage(unittest.TestCase):
+    def make_helper(self, log_sequence=None, old_hist=None, **kwargs):
+        return ot.OptimisationHelper(
+            lambda x: [opt.rosen(x), opt.rosen_der(x)],
+            [
+                ot.tasks.LogOptimisation(log_sequence or ot.seq_exp_lin(1.0, 1.0), old_hist=old_hist),
+                ot.tasks.MemoryUsage(ot.seq_exp_lin(1.0, 2.0, 1.0, 2.0), trigger="iter", **kwargs)
+            ]
+        )
+
+    def test_columns(self):
+        optlog = self.make_helper(num_allocations=3, hist_name="hist")
+        for _ in range(4):
+            optlog.callback(np.zeros(2))
+        hist = optlog.hist
+        self.assertTrue(len(hist) == 4)
+        self.assertTrue(list(np.isfinite(hist.rss.astype(float))) == [True, False, True, False])
+        self.assertTrue(np.all(hist.rss.dropna() > 0) and np.all(hist.hist_size.dropna() > 0))
+        self.assertTrue(len(hist.top_allocations.iloc[0].split("\n")) == 3)
+
+    def test_separate_hist(self):
+        optlog = self.make_helper(ot.seq_exp_lin(1.0, 2.0, 2.0, 2.0))
+        for _ in range(4):
+            optlog.callback(np.zeros(2))
+        self.assertTrue(list(optlog.hist.i) == [2, 4])
+        self.assertTrue('rss' not in optlog.hist.columns)
+        self.assertTrue(list(optlog.memory_hist.i) == [1, 3])
+        self.assertTrue(np.all(optlog.memory_hist.rss > 0))
+
+    def test_resume(self):
+        # Samples for iterations that weren't logged are not added to the optimiser's history
+        optlog = self.make_helper(ot.seq_exp_lin(1.0, 1.0, 2.0), hist_name="hist")
+        for _ in range(3):
+            optlog.callback(np.zeros(2))
+        self.assertTrue(list(optlog.hist.i) == [2, 3])
+        self.assertTrue(np.isfinite(optlog.hist.rss.iloc[-1]))
+
+        resumed = self.make_helper(ot.seq_exp_lin(1.0, 1.0, 2.0), old_hist=optlog.hist, hist_name="hist")
+        self.assertTrue(resumed._i == 3)
+        resumed.callback(np.zeros(2))
+        self.assertTrue(list(resumed.hist.i) == [2, 3, 4])
+        self.assertTrue(np.all(np.isfinite(resumed.hist.f.astype(float))))
+
+    def test_stop(self):
+        optlog = self.make_helper(max_rss=1, on_exceed="stop")
+        with self.assertRaises(ot.OptimisationTimeout):
+            optlog.callback(np.zeros(2))
+        self.assertTrue(np.isfinite(optlog.memory_hist.rss.iloc[-1]))
+
+
+class RecordingTask(ot.tasks.OptimisationIterationEvent):
+    def __init__(self, name, order, duration=0.1):
+        ot.tasks.OptimisationIterationEvent.__init__(self, ot.seq_exp_lin(1.0, 1.0))
+        self.name = name
+        self.order = order
+        self.duration = duration
+
+    def _event_handler(self, logger, x, final):
+        self.order.append(self.name + "-start")
+        time.sleep(self.duration)
+        self.order.append(self.name + "-end")
+
+
+class TestConcurrentTasks(unittest.TestCase):
+    def test_concurrent(self):
+        order = []
+        a = RecordingTask("a", order).concurrent()
+        b = RecordingTask("b", order).concurrent()
+        c = RecordingTask("c", order).concurrent(after=[a])
+        d = RecordingTask("d", order, 0.0)
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [a, b, c, d])
+        st = time.time()
+        optlog.callback(np.zeros(1))
+        self.assertTrue(time.time() - st < 0.3)
+        self.assertTrue(order.index("c-start") > order.index("a-end"))
+        self.assertTrue(order.index("b-start") < order.index("a-end"))
+        self.assertTrue(order[-2:] == ["d-start", "d-end"])
+
+    def test_sequential(self):
+        order = []
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [RecordingTask(n, order, 0.01) for n in "abc"])
+        optlog.callback(np.zeros(1))
+        self.assertTrue(order == ["a-start", "a-end", "b-start", "b-end", "c-start", "c-end"])
+
+    def test_error(self):
+        order = []
+        failing = RecordingTask("a", order, 0.01).concurrent()
+        failing._event_handler = lambda logger, x, final: 1 / 0
+        optlog = ot.OptimisationHelper(
+            lambda x: [0.0, 0.0],
+            [failing, RecordingTask("b", order).concurrent(), RecordingTask("c", order).concurrent(after=[failing])]
+        )
+        with self.assertRaises(ZeroDivisionError):
+            optlog.callback(np.zeros(1))
+        self.assertTrue(order == ["b-start", "b-end"])  # Running tasks are joined, dependent ones don't start
+
+    def test_dependency_order(self):
+        order = []
+        a = RecordingTask("a", order, 0.01).concurrent()
+        log = RecordingTask("log", order, 0.01)
+        store = RecordingTask("store", order, 0.01).concurrent(after=[log])
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [a, store, log])
+        with self.assertRaises(ValueError):
+            optlog.callback(np.zeros(1))
+        self.assertTrue(order == [])
+
+        missing = RecordingTask("store", order, 0.01).concurrent(after=[RecordingTask("other", order)])
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [a, missing])
+        with self.assertRaises(ValueError):
+            optlog.callback(np.zeros(1))
+
+        optlog = ot.OptimisationHelper(lambda x: [0.0, 0.0], [a, log, store])
+        optlog.callback(np.zeros(1))
+        self.assertTrue(order.index("store-start") > order.index("log-end"))
@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+import scipy.optimize as opt
+
+sys.path.append('..')
+import opt_tools as ot
+
+
+def slow_rosen(x):
+    time.sleep(0.001)
+    return [opt.rosen(x), opt.rosen_der(x)]
+
+
+class TestEvaluationTrace(unittest.TestCase):
+    def run_optimisation(self, trace, store_path=None):
+        optlog = ot.OptimisationHelper(
+            slow_rosen,
+            [ot.tasks.LogOptimisation(ot.seq_exp_lin(1.0, 1.0))] +
+            ([ot.tasks.StoreOptimisationHistory(store_path, None)] if store_path is not None else []),
+            trace=trace
+        )
+        r = opt.minimize(optlog._fg, jac=True, x0=np.array([-1.0, 1.0]), method='CG', callback=optlog.callback)
+        optlog.finish(r.x)
+        return r
+
+    def test_trace(self):
+        trace = ot.EvaluationTrace()
+        r = self.run_optimisation(trace)
+        evals = trace.to_frame()
+        self.assertTrue(np.sum(~evals.internal) == r.nfev)
+        self.assertTrue(np.sum(evals.internal) == r.nit + 1)  # Logging, and the final log
+        self.assertTrue(np.all(evals.duration >= 0.001))
+        self.assertTrue(evals.iteration.iloc[-1] == r.nit)
+        self.assertTrue(evals.f.iloc[-1] == opt.rosen(r.x))
+        self.assertTrue(np.isnan(evals.step.iloc[0]) and np.all(evals.step.iloc[1:] >= 0.0))
+
+    def test_ring_buffer(self):
+        store_path = os.path.join(tempfile.mkdtemp(), 'hist.pkl')
+        trace = ot.EvaluationTrace(capacity=10, profile_every=5, max_profiles=2)
+        self.run_optimisation(trace, store_path)
+        evals = trace.to_frame()
+        self.assertTrue(trace.num_evaluations > 10)
+        self.assertTrue(len(evals) == 10)
+        self.assertTrue(np.all(np.diff(evals.timestamp) >= 0.0))
+        self.assertTrue(len(trace.profiles) == 2)
+        self.assertTrue("slow_rosen" in trace.profiles[0][2])
+
+        stored = pd.read_pickle(store_path + ".trace")
+        self.assertTrue(len(stored['evaluations']) == 10)